@@ -0,0 +1,54 @@
+# Measures the cold start cost of building the automap classes used by the controllers
+# usage: python -m benchmarks.cold_start [rounds]
+#
+# - per_table: the previous behaviour, one engine and one full reflection per table lookup (8 at import time)
+# - reflect_once: a single reflection shared by every controller
+# - snapshot: metadata loaded from a DB_SCHEMA_SNAPSHOT file, no db query (the migrations are compared with initdb/)
+# - snapshot_verify: same with DB_SCHEMA_SNAPSHOT_VERIFY, the live schema is compared too (information_schema queries)
+import os
+import sys
+import tempfile
+from statistics import median
+from time import perf_counter
+from sqlalchemy import create_engine
+from sqlalchemy.ext.automap import automap_base
+from src.db import connection
+
+TABLE_LOOKUPS = 8
+
+def per_table():
+  for _ in range(TABLE_LOOKUPS):
+    engine = create_engine(connection.db_url)
+    Base = automap_base()
+    Base.prepare(autoload_with=engine)
+    engine.dispose()
+
+def reflect_once():
+  engine = create_engine(connection.db_url)
+  Base = automap_base()
+  Base.prepare(autoload_with=engine)
+  engine.dispose()
+
+def snapshot(path, verify=False):
+  connection.schema_snapshot_verify = verify
+  Base = automap_base(metadata=connection.load_schema_snapshot(path))
+  Base.prepare()
+
+def measure(fn, rounds):
+  timings = []
+  for _ in range(rounds):
+    start = perf_counter()
+    fn()
+    timings.append((perf_counter() - start) * 1000)
+  return median(timings)
+
+if __name__ == "__main__":
+  rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+  path = os.path.join(tempfile.mkdtemp(), "schema.pickle")
+  connection.dump_schema_snapshot(path)
+
+  print("{:<16}{:>12}".format("strategy", "median ms"))
+  print("{:<16}{:>12.2f}".format("per_table", measure(per_table, rounds)))
+  print("{:<16}{:>12.2f}".format("reflect_once", measure(reflect_once, rounds)))
+  print("{:<16}{:>12.2f}".format("snapshot", measure(lambda: snapshot(path), rounds)))
+  print("{:<16}{:>12.2f}".format("snapshot_verify", measure(lambda: snapshot(path, verify=True), rounds)))
@@ -0,0 +1,196 @@
+# Runs the scripted workloads against the api and reports throughput and p50/p95/p99 latencies
+# usage:
+#   python -m benchmarks.seed --reset                                   # once, see benchmarks/seed.py
+#   python -m benchmarks.load [--target asgi|uvicorn|http://host:port] [--workloads browse,search]
+#                             [--concurrency 16] [--duration 10] [--output report.json]
+#                             [--baseline benchmarks/baseline.json] [--tolerance 0.15]
+#
+# - asgi: the app is served in-process through httpx.ASGITransport (no network, no server)
+# - uvicorn: a uvicorn server is started on a free port (--workers processes) and stopped at the end
+# - http://...: an api already running, reading the same db as this process (for the seeded ids and tokens)
+#
+# --db sqlite:///./bench.db runs everything on a sqlite stand-in instead of MariaDB.
+# With --baseline the run is compared to a stored report and exits with 1 when a workload lost more than
+# --tolerance of its throughput or its p95 grew by more than --tolerance (store one with --output)
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+from time import perf_counter
+import httpx
+from benchmarks.login_storm import percentile
+
+DEFAULT_WORKLOADS = "browse,search,login_storm,comment_burst,upload"
+
+async def client_loop(client, workload, context, stop, latencies, errors):
+  while not stop.is_set():
+    start = perf_counter()
+    try:
+      response = await workload(client, context)
+      failed = response.status_code >= 400
+    except httpx.HTTPError:
+      failed = True
+    latencies.append((perf_counter() - start) * 1000)
+    if failed:
+      errors.append(1)
+
+# Runs one workload with concurrency virtual clients, the warmup requests are not measured
+async def run_workload(client, workload, context, concurrency, duration, warmup):
+  for phase_duration, measured in ((warmup, False), (duration, True)):
+    if phase_duration <= 0:
+      continue
+    stop = asyncio.Event()
+    latencies, errors = [], []
+    tasks = [asyncio.create_task(client_loop(client, workload, context, stop, latencies, errors)) for _ in range(concurrency)]
+    started = perf_counter()
+    await asyncio.sleep(phase_duration)
+    stop.set()
+    await asyncio.gather(*tasks)
+    elapsed = perf_counter() - started
+  return {
+    "requests": len(latencies),
+    "errors": len(errors),
+    "throughput_rps": round(len(latencies) / elapsed, 2),
+    "p50_ms": round(percentile(latencies, 50), 2),
+    "p95_ms": round(percentile(latencies, 95), 2),
+    "p99_ms": round(percentile(latencies, 99), 2),
+  }
+
+async def run_workloads(client, names, args):
+  from benchmarks.workloads import WORKLOADS, load_context, make_upload_file
+  upload_file = args.upload_file
+  if "upload" in names and upload_file is None:
+    upload_file = make_upload_file()
+    if upload_file is None:
+      print("ffmpeg not found and no --upload-file given, skipping the upload workload")
+      names = [name for name in names if name != "upload"]
+  context = load_context(upload_file)
+
+  results = {}
+  for name in names:
+    results[name] = await run_workload(client, WORKLOADS[name], context, args.concurrency, args.duration, args.warmup)
+    print_row(name, results[name])
+  return results
+
+async def run_in_process(names, args):
+  from src.main import app
+  async with app.router.lifespan_context(app):
+    # the errors of the app are answered (and counted) like over http instead of being raised in the client
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+      return await run_workloads(client, names, args)
+
+async def run_over_http(base_url, names, args):
+  async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=httpx.Limits(max_connections=args.concurrency)) as client:
+    return await run_workloads(client, names, args)
+
+# Starts uvicorn on a free port and waits until it answers
+async def start_uvicorn(workers):
+  with socket.socket() as probe:
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+  server = subprocess.Popen([
+    sys.executable, "-m", "uvicorn", "src.main:app",
+    "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers), "--log-level", "warning",
+  ])
+  base_url = "http://127.0.0.1:{}".format(port)
+  async with httpx.AsyncClient(base_url=base_url) as client:
+    for _ in range(600):
+      if server.poll() is not None:
+        raise SystemExit("uvicorn exited with {}".format(server.returncode))
+      try:
+        await client.get("/")
+        return server, base_url
+      except httpx.TransportError:
+        await asyncio.sleep(0.1)
+  server.terminate()
+  raise SystemExit("uvicorn did not start within 60s")
+
+async def run(names, args):
+  if args.target == "asgi":
+    return await run_in_process(names, args)
+  if args.target == "uvicorn":
+    server, base_url = await start_uvicorn(args.workers)
+    try:
+      return await run_over_http(base_url, names, args)
+    finally:
+      server.terminate()
+      server.wait()
+  return await run_over_http(args.target, names, args)
+
+############################################################## REPORT ##############################################################
+
+def print_header():
+  print("{:<16}{:>10}{:>8}{:>12}{:>10}{:>10}{:>10}".format("workload", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+
+def print_row(name, result):
+  print("{:<16}{:>10}{:>8}{:>12.1f}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+    name, result["requests"], result["errors"], result["throughput_rps"], result["p50_ms"], result["p95_ms"], result["p99_ms"],
+  ))
+
+# Returns the regressions of report against baseline, as printable lines
+def compare(report, baseline, tolerance):
+  regressions = []
+  for name, base in baseline["workloads"].items():
+    current = report["workloads"].get(name)
+    if current is None:
+      continue
+    if base["throughput_rps"] and current["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+      regressions.append("{}: throughput {:.1f} req/s, baseline {:.1f}".format(name, current["throughput_rps"], base["throughput_rps"]))
+    if base["p95_ms"] and current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+      regressions.append("{}: p95 {:.2f} ms, baseline {:.2f}".format(name, current["p95_ms"], base["p95_ms"]))
+    if current["errors"] > base["errors"]:
+      regressions.append("{}: {} errors, baseline {}".format(name, current["errors"], base["errors"]))
+  return regressions
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Load benchmark of the api")
+  parser.add_argument("--target", default="asgi", help="asgi, uvicorn or the base url of a running api")
+  parser.add_argument("--workloads", default=DEFAULT_WORKLOADS)
+  parser.add_argument("--concurrency", type=int, default=16)
+  parser.add_argument("--duration", type=float, default=10, help="measured seconds per workload")
+  parser.add_argument("--warmup", type=float, default=2, help="unmeasured seconds before each workload")
+  parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes (--target uvicorn)")
+  parser.add_argument("--db", help="db url of the api, e.g. sqlite:///./bench.db (default: the DB_* environment)")
+  parser.add_argument("--upload-file", help="mp4 sent by the upload workload (default: generated with ffmpeg)")
+  parser.add_argument("--output", help="writes the json report to this file")
+  parser.add_argument("--baseline", help="json report to compare with")
+  parser.add_argument("--tolerance", type=float, default=0.15)
+  return parser.parse_args()
+
+if __name__ == "__main__":
+  args = parse_args()
+  # the app reads its settings at import time, and so do the uvicorn workers started from this environment
+  if args.db:
+    os.environ["DB_URL"] = args.db
+  os.environ.setdefault("SECRET_KEY", "bench-secret")
+  # renditions would compete with the api for the cores, the upload workload measures the upload itself
+  os.environ.setdefault("TRANSCODE_ENABLED", "false")
+
+  names = [name.strip() for name in args.workloads.split(",") if name.strip()]
+  print_header()
+  results = asyncio.run(run(names, args))
+  report = {
+    "target": args.target if args.target in ("asgi", "uvicorn") else "http",
+    "concurrency": args.concurrency,
+    "duration": args.duration,
+    "workloads": results,
+  }
+
+  if args.output:
+    with open(args.output, "w") as output:
+      json.dump(report, output, indent=2, sort_keys=True)
+      output.write("\n")
+
+  if args.baseline:
+    with open(args.baseline) as baseline_file:
+      regressions = compare(report, json.load(baseline_file), args.tolerance)
+    if regressions:
+      print("\nRegressions against {}:".format(args.baseline))
+      for regression in regressions:
+        print("  - {}".format(regression))
+      sys.exit(1)
+    print("\nNo regression against {}".format(args.baseline))
@@ -0,0 +1,65 @@
+# Measures the latency of an unrelated endpoint (GET /) while the api is flooded with logins
+# usage: python -m benchmarks.login_storm [base_url] [concurrent_logins] [duration_s]
+#
+# With bcrypt running inline in the event loop, every login froze the loop for 100-300 ms
+# and the p99 of GET / followed; with the bcrypt pool it should stay close to the idle p99
+import asyncio
+import sys
+import uuid
+from time import perf_counter
+import httpx
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+async def probe_root(client, stop, latencies):
+  while not stop.is_set():
+    start = perf_counter()
+    await client.get("/")
+    latencies.append((perf_counter() - start) * 1000)
+    await asyncio.sleep(0.01)
+
+async def login_loop(client, stop, credentials, logins):
+  while not stop.is_set():
+    start = perf_counter()
+    await client.post("/auth", json=credentials)
+    logins.append((perf_counter() - start) * 1000)
+
+async def run_phase(client, concurrency, duration, credentials):
+  stop = asyncio.Event()
+  root_latencies, logins = [], []
+  tasks = [asyncio.create_task(probe_root(client, stop, root_latencies))]
+  tasks += [asyncio.create_task(login_loop(client, stop, credentials, logins)) for _ in range(concurrency)]
+  await asyncio.sleep(duration)
+  stop.set()
+  await asyncio.gather(*tasks)
+  return root_latencies, logins
+
+async def main(base_url, concurrency, duration):
+  suffix = uuid.uuid4().hex[:8]
+  credentials = {"login": "storm_{}".format(suffix), "password": "storm-password"}
+  async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+    await client.post("/user", json={
+      "username": credentials["login"],
+      "email": "storm_{}@bench.local".format(suffix),
+      "pseudo": "storm",
+      "password": credentials["password"],
+    })
+
+    print("{:<14}{:>10}{:>10}{:>10}{:>16}".format("phase", "GET / n", "p50 ms", "p99 ms", "logins/s"))
+    for phase, logins_concurrency in (("idle", 0), ("login storm", concurrency)):
+      root_latencies, logins = await run_phase(client, logins_concurrency, duration, credentials)
+      print("{:<14}{:>10}{:>10.2f}{:>10.2f}{:>16.1f}".format(
+        phase,
+        len(root_latencies),
+        percentile(root_latencies, 50),
+        percentile(root_latencies, 99),
+        len(logins) / duration,
+      ))
+
+if __name__ == "__main__":
+  base_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8000"
+  concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+  duration = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+  asyncio.run(main(base_url, concurrency, duration))
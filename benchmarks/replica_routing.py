@@ -0,0 +1,82 @@
+# Checks the read replica routing of the api on two sqlite files, no MariaDB needed
+# usage: python -m benchmarks.replica_routing
+#
+# The replica is a copy of the seeded primary whose video names are prefixed with "replica",
+# so every response tells which db served it (all of its videos for a listing). The writes made during
+# the check only reach the primary, like a replica lagging behind. Exits with 1 when a check fails
+import asyncio
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+WINDOW = 1
+
+def configure(directory):
+  primary = os.path.join(directory, "primary.db")
+  replica = os.path.join(directory, "replica.db")
+  # the app reads its settings at import time
+  os.environ["DB_URL"] = "sqlite:///{}".format(primary)
+  os.environ["DB_REPLICA_URLS"] = "sqlite:///{}".format(replica)
+  os.environ["DB_READ_YOUR_WRITES_WINDOW"] = str(WINDOW)
+  os.environ["VIDEO_LIST_CACHE_ENABLED"] = "true"
+  os.environ["TRANSCODE_ENABLED"] = "false"
+  os.environ.setdefault("SECRET_KEY", "bench-secret")
+  return primary, replica
+
+def seed(primary, replica):
+  from benchmarks import seed
+  from src.db.connection import get_engine
+  seed.run(users=2, videos_per_user=2, formats_per_video=1, comments_per_video=1, reset=True)
+  get_engine().dispose()
+  shutil.copyfile(primary, replica)
+  with sqlite3.connect(replica) as connection:
+    connection.execute("UPDATE video SET name = 'replica ' || name")
+
+async def check(results, label, response, expect_replica):
+  videos = response.json().get("data", [])
+  served_by_replica = bool(videos) and all(video["name"].startswith("replica ") for video in videos)
+  ok = response.status_code == 200 and served_by_replica == expect_replica
+  results.append(ok)
+  print("{:<6}{:<58}{}".format("ok" if ok else "FAIL", label, "replica" if served_by_replica else "primary"))
+
+async def run():
+  from httpx import AsyncClient, ASGITransport
+  from sqlalchemy import select
+  from benchmarks.seed import token_table
+  from src.db.connection import get_engine
+  from src.main import app
+
+  with get_engine().connect() as connection:
+    token = connection.execute(select(token_table.c.code).where(token_table.c.user_id == 1)).scalar()
+  owner = {"Authorization": token}
+
+  results = []
+  async with app.router.lifespan_context(app):
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://check") as client:
+      await check(results, "anonymous read goes to the replica", await client.get("/videos/batch", params={"ids": "1,2"}), True)
+      await check(results, "cached listing is filled from the replica", await client.get("/videos", params={"perPage": 10}), True)
+      await check(results, "authenticated read goes to the replica", await client.request("GET", "/user/1/videos", headers=owner, json={}), True)
+
+      response = await client.put("/video/1", headers=owner, json={"name": "renamed on the primary", "user": 1})
+      results.append(response.status_code == 200)
+      print("{:<6}{:<58}{}".format("ok" if results[-1] else "FAIL", "write goes to the primary", response.status_code))
+
+      await check(results, "read of the writer within the window goes to the primary", await client.request("GET", "/user/1/videos", headers=owner, json={}), False)
+      await check(results, "anonymous read still goes to the replica", await client.get("/videos/batch", params={"ids": "1,2"}), True)
+      await check(results, "invalidated listing is refilled from the primary", await client.get("/videos", params={"perPage": 10}), False)
+      await asyncio.sleep(WINDOW + 0.5)
+      await check(results, "read of the writer after the window goes to the replica", await client.request("GET", "/user/1/videos", headers=owner, json={}), True)
+  return all(results)
+
+if __name__ == "__main__":
+  directory = tempfile.mkdtemp(prefix="replica-routing-")
+  try:
+    primary, replica = configure(directory)
+    seed(primary, replica)
+    passed = asyncio.run(run())
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+  print("\nReplica routing {}".format("works" if passed else "is broken"))
+  sys.exit(0 if passed else 1)
@@ -0,0 +1,66 @@
+# Compares LIKE '%term%' with the FULLTEXT index on a seeded table of video names
+# usage: python -m benchmarks.search [rows] [rounds]
+#
+# The rows are written to a scratch table (bench_video_search) that is dropped at the end
+import random
+import sys
+from statistics import median
+from time import perf_counter
+from sqlalchemy import text
+from src.db.connection import get_engine
+
+WORDS = [
+  "cat", "dog", "travel", "music", "live", "tutorial", "python", "cooking", "review", "gaming",
+  "football", "trailer", "vlog", "podcast", "unboxing", "concert", "guitar", "drawing", "workout", "news",
+]
+SEARCHES = ["python", "guitar tutorial", "cooking live", "concert"]
+BATCH_SIZE = 10000
+
+def seed(connection, rows):
+  connection.execute(text("DROP TABLE IF EXISTS bench_video_search"))
+  connection.execute(text(
+    "CREATE TABLE bench_video_search ("
+    " id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,"
+    " name VARCHAR(255) NOT NULL"
+    ") ENGINE = InnoDB"
+  ))
+  insert = text("INSERT INTO bench_video_search (name) VALUES (:name)")
+  for start in range(0, rows, BATCH_SIZE):
+    count = min(BATCH_SIZE, rows - start)
+    connection.execute(insert, [{"name": " ".join(random.choices(WORDS, k=4))} for _ in range(count)])
+  # built after the load, like on an existing table
+  connection.execute(text("CREATE FULLTEXT INDEX ft_bench_name ON bench_video_search (name)"))
+
+def measure(connection, statement, params, rounds):
+  timings = []
+  for _ in range(rounds):
+    start = perf_counter()
+    connection.execute(statement, params).fetchall()
+    timings.append((perf_counter() - start) * 1000)
+  return median(timings)
+
+if __name__ == "__main__":
+  rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+  random.seed(42)
+
+  like = text("SELECT id, name FROM bench_video_search WHERE name LIKE :search ORDER BY id LIMIT 20")
+  fulltext = text(
+    "SELECT id, name FROM bench_video_search WHERE MATCH(name) AGAINST(:search IN BOOLEAN MODE)"
+    " ORDER BY MATCH(name) AGAINST(:search IN BOOLEAN MODE) DESC, id LIMIT 20"
+  )
+
+  with get_engine().begin() as connection:
+    print("Seeding {} rows...".format(rows))
+    seed(connection, rows)
+    try:
+      print("{:<18}{:>14}{:>14}".format("search", "like ms", "fulltext ms"))
+      for search in SEARCHES:
+        boolean_query = " ".join("+{}*".format(word) for word in search.split())
+        print("{:<18}{:>14.2f}{:>14.2f}".format(
+          search,
+          measure(connection, like, {"search": "%{}%".format(search)}, rounds),
+          measure(connection, fulltext, {"search": boolean_query}, rounds),
+        ))
+    finally:
+      connection.execute(text("DROP TABLE IF EXISTS bench_video_search"))
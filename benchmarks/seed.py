@@ -0,0 +1,179 @@
+# Seeds the db with users, videos, formats, comments and tokens for the benchmarks
+# usage: python -m benchmarks.seed [--users 1000] [--videos-per-user 10] [--comments-per-video 5] [--reset]
+#
+# The target is the db of the api (DB_URL / DB_HOST...), e.g. DB_URL=sqlite:///./bench.db for a stand-in
+# without MariaDB: the tables are created when missing. Every seeded user logs in with
+# username bench_<id> and password BENCH_PASSWORD, and owns one unexpired token
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, Text, Boolean, ForeignKey, Index, func, insert, select, delete
+from benchmarks.search import WORDS
+from src.db.connection import get_engine
+from src.security import hash_password, encode_token
+from src.transcoding import RENDITIONS, rendition_uri
+
+BENCH_PASSWORD = "bench-password"
+BATCH_SIZE = 5000
+
+# Tables of initdb/create-db.sql and the migrations, used to create the stand-in schema
+# (FULLTEXT indexes are MariaDB only: searches fall back to LIKE on sqlite)
+metadata = MetaData()
+
+user_table = Table(
+  "user", metadata,
+  Column("id", Integer, primary_key=True),
+  Column("username", String(45), nullable=False, unique=True),
+  Column("email", String(45), nullable=False, unique=True),
+  Column("pseudo", String(45)),
+  Column("password", String(255), nullable=False),
+  Column("created_at", DateTime, nullable=False),
+)
+
+video_table = Table(
+  "video", metadata,
+  Column("id", Integer, primary_key=True),
+  Column("name", String(255), nullable=False),
+  Column("duration", Integer),
+  Column("user_id", Integer, ForeignKey("user.id"), nullable=False),
+  Column("source", String(255), nullable=False),
+  Column("created_at", DateTime, nullable=False),
+  Column("views", Integer, nullable=False),
+  Column("enabled", Boolean, nullable=False),
+  Column("comments_count", Integer, nullable=False, server_default="0"),
+  Index("idx_video_user_duration", "user_id", "duration"),
+  Index("idx_video_duration", "duration"),
+)
+
+video_format_table = Table(
+  "video_format", metadata,
+  Column("id", Integer, primary_key=True),
+  Column("code", String(45), nullable=False),
+  Column("uri", String(45), nullable=False),
+  Column("video_id", Integer, ForeignKey("video.id"), nullable=False),
+  Index("idx_video_format_video_code", "video_id", "code"),
+)
+
+token_table = Table(
+  "token", metadata,
+  Column("id", Integer, primary_key=True),
+  Column("code", String(512), nullable=False, unique=True),
+  Column("expired_at", DateTime, nullable=False),
+  Column("user_id", Integer, ForeignKey("user.id"), nullable=False),
+  Index("idx_token_user_expired", "user_id", "expired_at"),
+  Index("idx_token_expired_at", "expired_at"),
+)
+
+comment_table = Table(
+  "comment", metadata,
+  Column("id", Integer, primary_key=True),
+  Column("body", Text),
+  Column("user_id", Integer, ForeignKey("user.id"), nullable=False),
+  Column("video_id", Integer, ForeignKey("video.id"), nullable=False),
+  Index("idx_comment_video_id", "video_id", "id"),
+)
+
+# children first, so the rows can be deleted in this order
+TABLES = [comment_table, token_table, video_format_table, video_table, user_table]
+
+def username(user_id: int) -> str:
+  return "bench_{}".format(user_id)
+
+def email(user_id: int) -> str:
+  return "{}@bench.local".format(username(user_id))
+
+def pseudo() -> str:
+  return "bench {}".format(random.choice(WORDS))
+
+def video_name() -> str:
+  return " ".join(random.choices(WORDS, k=4))
+
+# same claims as the tokens of the api (create_token)
+def token_code(user_id: int, pseudo: str, expires: datetime) -> str:
+  return encode_token(user_id, username(user_id), pseudo, email(user_id), expires, os.environ.get("SECRET_KEY", "bench-secret"))
+
+def insert_batches(connection, table, rows):
+  batch = []
+  for row in rows:
+    batch.append(row)
+    if len(batch) >= BATCH_SIZE:
+      connection.execute(insert(table), batch)
+      batch = []
+  if batch:
+    connection.execute(insert(table), batch)
+
+# Writes the rows of every table, ids start at 1 so the workloads can pick rows by id
+def seed(connection, users: int, videos_per_user: int, formats_per_video: int, comments_per_video: int):
+  now = datetime.now()
+  password = hash_password(BENCH_PASSWORD)
+  videos = users * videos_per_user
+  # kept for the claims of the tokens
+  pseudos = [None] + [pseudo() for _ in range(users)]
+
+  insert_batches(connection, user_table, ({
+    "id": user_id,
+    "username": username(user_id),
+    "email": email(user_id),
+    "pseudo": pseudos[user_id],
+    "password": password,
+    "created_at": now,
+  } for user_id in range(1, users + 1)))
+
+  insert_batches(connection, video_table, ({
+    "id": video_id,
+    "name": video_name(),
+    "duration": random.randint(5, 3600),
+    "user_id": (video_id - 1) % users + 1,
+    "source": "/bench/videos/{}.mp4".format(video_id),
+    "created_at": now,
+    "views": 0,
+    "enabled": True,
+    "comments_count": comments_per_video,
+  } for video_id in range(1, videos + 1)))
+
+  insert_batches(connection, video_format_table, ({
+    "code": code,
+    "uri": rendition_uri(video_id, code),
+    "video_id": video_id,
+  } for video_id in range(1, videos + 1) for code in RENDITIONS[-formats_per_video:] if formats_per_video > 0))
+
+  insert_batches(connection, comment_table, ({
+    "body": video_name(),
+    "user_id": random.randint(1, users),
+    "video_id": video_id,
+  } for video_id in range(1, videos + 1) for _ in range(comments_per_video)))
+
+  expires = now + timedelta(days=30)
+  insert_batches(connection, token_table, ({
+    "code": token_code(user_id, pseudos[user_id], expires),
+    "expired_at": expires,
+    "user_id": user_id,
+  } for user_id in range(1, users + 1)))
+
+# Creates the missing tables, then seeds them; refuses to write into a db holding data unless reset is set
+def run(users: int, videos_per_user: int, formats_per_video: int, comments_per_video: int, reset: bool = False):
+  engine = get_engine()
+  metadata.create_all(engine, checkfirst=True)
+  with engine.begin() as connection:
+    existing = connection.execute(select(func.count()).select_from(user_table)).scalar()
+    if existing and not reset:
+      raise SystemExit("The db already holds {} users, run with --reset to delete every row first".format(existing))
+    for table in TABLES:
+      connection.execute(delete(table))
+    seed(connection, users, videos_per_user, formats_per_video, comments_per_video)
+
+def add_arguments(parser):
+  parser.add_argument("--users", type=int, default=1000)
+  parser.add_argument("--videos-per-user", type=int, default=10)
+  parser.add_argument("--formats-per-video", type=int, default=3, help="renditions per video, at most {}".format(len(RENDITIONS)))
+  parser.add_argument("--comments-per-video", type=int, default=5)
+  parser.add_argument("--reset", action="store_true", help="delete every row of the tables before seeding")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Seeds the db for the benchmarks")
+  add_arguments(parser)
+  args = parser.parse_args()
+  random.seed(42)
+  run(args.users, args.videos_per_user, args.formats_per_video, args.comments_per_video, args.reset)
+  print("Seeded {} users, {} videos".format(args.users, args.users * args.videos_per_user))
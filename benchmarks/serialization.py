@@ -0,0 +1,42 @@
+# Compares the default FastAPI serialization (jsonable_encoder + json.dumps) with orjson
+# on a page of 100 videos shaped by video_to_json
+# usage: python -m benchmarks.serialization [rounds]
+import json
+import sys
+from datetime import datetime
+from statistics import median
+from time import perf_counter
+from types import SimpleNamespace
+from fastapi.encoders import jsonable_encoder
+from src.responses import dump_json
+from src.serializers import video_to_json
+
+def video_page(size=100):
+  now = datetime.now()
+  page = []
+  for id in range(1, size + 1):
+    user = SimpleNamespace(id=id % 7, username="user{}".format(id % 7), pseudo="pseudo", created_at=now)
+    formats = [SimpleNamespace(code=code, uri="videos/{}/{}.mp4".format(id, code)) for code in ("1080", "720", "480", "360")]
+    video = SimpleNamespace(id=id, name="video {}".format(id), source="/app/public/videos/{}.mp4".format(id),
+                            created_at=now, views=id * 10, enabled=1)
+    page.append(video_to_json(video, user, formats))
+  return {"message": "OK", "data": page, "pager": {"current": 1, "total": 10, "next_cursor": None}}
+
+def default_encoder(content):
+  return json.dumps(jsonable_encoder(content), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def measure(fn, content, rounds):
+  timings = []
+  for _ in range(rounds):
+    start = perf_counter()
+    fn(content)
+    timings.append((perf_counter() - start) * 1000000)
+  return median(timings)
+
+if __name__ == "__main__":
+  rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+  content = video_page()
+  print("{:<28}{:>14}".format("serializer", "median us"))
+  print("{:<28}{:>14.1f}".format("jsonable_encoder + json", measure(default_encoder, content, rounds)))
+  print("{:<28}{:>14.1f}".format("orjson", measure(dump_json, content, rounds)))
+  print("{:<28}{:>14.1f}".format("video_to_json x100 + orjson", measure(lambda _: dump_json(video_page()), content, rounds)))
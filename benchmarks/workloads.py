@@ -0,0 +1,102 @@
+# Scripted workloads of the load benchmark (python -m benchmarks.load)
+# every workload is an async function sending one request, run in a loop by each virtual client;
+# the rows they touch are picked among the ones written by benchmarks.seed
+import random
+import shutil
+import subprocess
+import tempfile
+from benchmarks.search import WORDS
+from benchmarks.seed import BENCH_PASSWORD, username
+
+# Ids and tokens of the seeded db, read once before the workloads start
+class Context:
+  def __init__(self, users: int, videos: int, tokens: dict, upload_file: str = None):
+    self.users = users
+    self.videos = videos
+    self.tokens = tokens
+    self.upload_file = upload_file
+
+  def user_id(self) -> int:
+    return random.randint(1, self.users)
+
+  def video_id(self) -> int:
+    return random.randint(1, self.videos)
+
+  # a user holding a seeded token and its Authorization header
+  def authorized_user(self):
+    user_id = random.choice(list(self.tokens))
+    return user_id, {"Authorization": self.tokens[user_id]}
+
+# Loads the seeded row counts and tokens
+def load_context(upload_file: str = None) -> Context:
+  from sqlalchemy import select, func
+  from benchmarks.seed import user_table, video_table, token_table
+  from src.db.connection import get_engine
+  with get_engine().connect() as connection:
+    users = connection.execute(select(func.count()).select_from(user_table)).scalar()
+    videos = connection.execute(select(func.count()).select_from(video_table)).scalar()
+    rows = connection.execute(select(token_table.c.user_id, token_table.c.code).where(token_table.c.expired_at > func.now()).limit(1000)).all()
+  if not users or not videos or not rows:
+    raise SystemExit("The db is empty, seed it first: python -m benchmarks.seed")
+  return Context(users, videos, {row.user_id: row.code for row in rows}, upload_file)
+
+# Makes a small mp4 for the upload workload, None when ffmpeg is not installed
+def make_upload_file():
+  if shutil.which("ffmpeg") is None:
+    return None
+  path = tempfile.NamedTemporaryFile(prefix="bench-upload-", suffix=".mp4", delete=False).name
+  subprocess.run([
+    "ffmpeg", "-y", "-loglevel", "error",
+    "-f", "lavfi", "-i", "testsrc=duration=2:size=320x240:rate=25",
+    "-pix_fmt", "yuv420p", path,
+  ], check=True)
+  return path
+
+############################################################## WORKLOADS ##############################################################
+
+# public listing pages, with and without a filter on the owner (by username, a number would be taken for one)
+# the pages are picked among the seeded ones
+async def browse(client, context):
+  per_page = 10
+  if random.random() < 0.3:
+    pages = -(-context.videos // context.users // per_page)
+    params = {"user": username(context.user_id()), "page": random.randint(1, max(pages, 1)), "perPage": per_page}
+  else:
+    params = {"page": random.randint(1, min(20, max(-(-context.videos // per_page), 1))), "perPage": per_page}
+  return await client.get("/videos", params=params)
+
+# name searches, one or two words
+async def search(client, context):
+  return await client.get("/videos", params={"name": " ".join(random.sample(WORDS, random.choice((1, 2)))), "perPage": 10})
+
+# logins of the seeded users (bcrypt bound)
+async def login_storm(client, context):
+  user_id = context.user_id()
+  return await client.post("/auth", json={"login": username(user_id), "password": BENCH_PASSWORD})
+
+# uploads of a small video by a user holding a token
+async def upload(client, context):
+  user_id, headers = context.authorized_user()
+  with open(context.upload_file, "rb") as source:
+    return await client.post(
+      "/user/{}/video".format(user_id),
+      headers=headers,
+      data={"name": "bench upload"},
+      files={"source": ("bench.mp4", source, "video/mp4")},
+    )
+
+# comments posted on a handful of hot videos, then their first page read back
+async def comment_burst(client, context):
+  _, headers = context.authorized_user()
+  video_id = random.randint(1, min(5, context.videos))
+  if random.random() < 0.5:
+    return await client.post("/video/{}/comment".format(video_id), headers=headers, json={"body": "bench comment"})
+  return await client.request("GET", "/video/{}/comments".format(video_id), headers=headers, json={"page": 1, "perPage": 10})
+
+WORKLOADS = {
+  "browse": browse,
+  "search": search,
+  "login_storm": login_storm,
+  "upload": upload,
+  "comment_burst": comment_burst,
+}
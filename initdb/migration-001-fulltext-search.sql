@@ -0,0 +1,9 @@
+-- -----------------------------------------------------
+-- Full-text indexes for the searches on video names and user pseudos
+-- (applied by the db container on first start, `make migrate` for an existing db)
+-- -----------------------------------------------------
+USE `mydb`;
+
+CREATE FULLTEXT INDEX IF NOT EXISTS `ft_video_name` ON `mydb`.`video` (`name`);
+
+CREATE FULLTEXT INDEX IF NOT EXISTS `ft_user_pseudo` ON `mydb`.`user` (`pseudo`);
@@ -0,0 +1,17 @@
+-- -----------------------------------------------------
+-- Indexes for the filters of the controllers (checked by `python -m src.db.explain`)
+-- InnoDB appends the primary key to secondary indexes, so they also serve the ORDER BY id of the listings
+-- -----------------------------------------------------
+USE `mydb`;
+
+-- get_videos: user_id = ? AND duration BETWEEN ? AND ? (listing and count)
+CREATE INDEX IF NOT EXISTS `idx_video_user_duration` ON `mydb`.`video` (`user_id`, `duration`);
+
+-- get_videos: duration BETWEEN ? AND ? without user
+CREATE INDEX IF NOT EXISTS `idx_video_duration` ON `mydb`.`video` (`duration`);
+
+-- add_video_format / get_video_file: video_id = ? AND code = ?
+CREATE INDEX IF NOT EXISTS `idx_video_format_video_code` ON `mydb`.`video_format` (`video_id`, `code`);
+
+-- get_active_tokens: user_id = ? AND expired_at > ?
+CREATE INDEX IF NOT EXISTS `idx_token_user_expired` ON `mydb`.`token` (`user_id`, `expired_at`);
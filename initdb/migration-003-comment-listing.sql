@@ -0,0 +1,14 @@
+-- -----------------------------------------------------
+-- Comment listing: newest first per video, counted without scanning the comments
+-- -----------------------------------------------------
+USE `mydb`;
+
+-- get_comments_of_video: video_id = ? ORDER BY id DESC (and id < cursor)
+CREATE INDEX IF NOT EXISTS `idx_comment_video_id` ON `mydb`.`comment` (`video_id`, `id`);
+
+-- number of comments of the video, incremented by add_comment_to_video
+ALTER TABLE `mydb`.`video` ADD COLUMN IF NOT EXISTS `comments_count` INT NOT NULL DEFAULT 0;
+
+UPDATE `mydb`.`video` SET `comments_count` = (
+    SELECT COUNT(*) FROM `mydb`.`comment` WHERE `comment`.`video_id` = `video`.`id`
+);
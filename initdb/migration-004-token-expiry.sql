@@ -0,0 +1,10 @@
+-- -----------------------------------------------------
+-- Token housekeeping: the sweeper deletes expired tokens oldest first, in batches
+-- -----------------------------------------------------
+USE `mydb`;
+
+-- delete_expired_tokens: expired_at < NOW() ORDER BY expired_at LIMIT ?
+CREATE INDEX IF NOT EXISTS `idx_token_expired_at` ON `mydb`.`token` (`expired_at`);
+
+-- the codes are signed JWTs carrying username, pseudo, email and a jti: longer than 255 characters
+ALTER TABLE `mydb`.`token` MODIFY `code` VARCHAR(512) NOT NULL;
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+# Bounded in-process cache: least recently used entries are evicted once maxsize is reached
+# and every entry expires after its ttl (seconds)
+class TTLCache:
+  def __init__(self, maxsize: int, ttl: float):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = Lock()
+
+  # returns the cached value, or default when missing or expired
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None or entry[0] <= monotonic():
+        if entry is not None:
+          del self._entries[key]
+        self.misses += 1
+        return default
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[1]
+
+  # caches value for ttl seconds (the cache ttl when None, never longer than it)
+  def set(self, key, value, ttl: float = None):
+    ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+    if ttl <= 0:
+      return
+    with self._lock:
+      self._entries[key] = (monotonic() + ttl, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+
+  def delete(self, key):
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  # tells if key holds an unexpired value, without counting a hit or a miss
+  def __contains__(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      return entry is not None and entry[0] > monotonic()
+
+  def __len__(self):
+    return len(self._entries)
+
+  # hit/miss counters of the cache
+  def stats(self):
+    total = self.hits + self.misses
+    return {
+      "size": len(self._entries),
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_ratio": self.hits / total if total else 0.0,
+    }
@@ -1,11 +1,15 @@
-from sqlalchemy import select, func
-from src.db.connection import get_session, get_base
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+from src.db.connection import get_session, get_base, run_with_session, run_read_only
 from src.models import ApiException
+from src.serializers import comment_to_json
+from src.pagination import fetch_page, INVALID_CURSOR_MSG
 from math import ceil
 
-UserDb = get_base().classes.user
-VideoDb = get_base().classes.video
-CommentDb = get_base().classes.comment
+Base = get_base()
+UserDb = Base.classes.user
+VideoDb = Base.classes.video
+CommentDb = Base.classes.comment
 
 # error message
 USER_NOT_FOUND_MSG = "User not found"
@@ -36,6 +40,8 @@ def add_comment_to_video(video_id: str, user_id: int, body: str):
       user_id=user_id
     )
     session.add(comment)
+    # keep the comment counter of the video in sync, in the same transaction
+    video.comments_count = VideoDb.comments_count + 1
     session.commit()
     return {
       "message": "OK",
@@ -51,8 +57,9 @@ def add_comment_to_video(video_id: str, user_id: int, body: str):
       raise ApiException(404, 1003, USER_NOT_FOUND_MSG)
     raise ApiException(500, 1999, "INTERNAL_ERROR")
 
-# this function will get list of comments of a video
-def get_comments_of_video(video_id: str, page: int, perPage: int):
+# this function will get list of comments of a video, newest first
+# after (a cursor) paginates on the (video_id, id) index, the total comes from the comment counter of the video
+def get_comments_of_video(video_id: str, page: int, perPage: int, after: str = None, withTotal: bool = False):
   session = get_session()
   try:
     if page < 1:
@@ -62,29 +69,23 @@ def get_comments_of_video(video_id: str, page: int, perPage: int):
       raise ValueError(VIDEO_NOT_FOUND_MSG)
     
     # get total number of comments
-    try:
-      total_comments = session.query(func.count(CommentDb.id)).filter(CommentDb.video_id == video_id).scalar()
-    except Exception as e:
-      raise ValueError("Error while getting total videos")
+    total_pages = ceil(video.comments_count / perPage)
     
-    # calculate pagination offset
-    offset = ((page -1 ) * perPage)
-    if offset < 0:
-      offset = 0
-    
-    # get comments
-    comments = session.query(CommentDb).filter(CommentDb.video_id == video_id).offset(offset).limit(perPage).all()
+    # get comments with their authors
+    sql_rec = select(CommentDb).where(CommentDb.video_id == video_id).options(joinedload(CommentDb.user))
+    comments, next_cursor = fetch_page(session, sql_rec, CommentDb.id, perPage, page, after, descending=True)
     
     # verify if pages exists (Page 1 always exists)
-    if (len(comments) == 0 and page != 1):
+    if (len(comments) == 0 and page != 1 and after is None):
       raise ValueError(PAGE_NOT_FOUND_MSG)
 
     return {
       "message": "OK",
       "data": [comment_to_json(comment) for comment in comments],
       "pager": {
-        "current": page,
-        "total": ceil(total_comments / perPage)
+        "current": page if after is None else None,
+        "total": total_pages,
+        "next_cursor": next_cursor,
       }
     }
   except Exception as e:
@@ -92,16 +93,16 @@ def get_comments_of_video(video_id: str, page: int, perPage: int):
       raise ApiException(404, 1004, VIDEO_NOT_FOUND_MSG)
     if PAGE_NOT_FOUND_MSG in str(e):
       raise ApiException(404, 1005, PAGE_NOT_FOUND_MSG)
+    if INVALID_CURSOR_MSG in str(e):
+      raise ApiException(400, 1001, INVALID_CURSOR_MSG)
     raise ApiException(500, 1999, "INTERNAL_ERROR")
   
 
-def comment_to_json(comment):
-  return {
-    "id": comment.id,
-    "body": comment.body,
-    "user": {
-      "id": comment.user.id,
-      "username": comment.user.username,
-      "pseudo": comment.user.pseudo,
-    }
-  }
+############################################################## ASYNC VERSIONS ##############################################################
+# db I/O of these is awaited on the async engine, so the event loop keeps serving other requests
+
+async def add_comment_to_video_async(video_id: str, user_id: int, body: str):
+  return await run_with_session(add_comment_to_video, video_id, user_id, body)
+
+async def get_comments_of_video_async(video_id: str, page: int, perPage: int, after: str = None, withTotal: bool = False):
+  return await run_read_only(get_comments_of_video, video_id, page, perPage, after, withTotal)
@@ -1,12 +1,38 @@
-from src.db.connection import get_session, get_base
+from src.db.connection import get_session, get_base, run_with_session, set_request_user
 from src.models import ApiException
+from src.cache import TTLCache
+from src.metrics import register_cache
+from src.security import encode_token
 from datetime import datetime, timedelta
-from sqlalchemy import select
+from sqlalchemy import select, delete
 from os import environ
 import jwt
 
 
-TokenDb = get_base().classes.token
+Base = get_base()
+TokenDb = Base.classes.token
+
+# "db" looks every token up in the db, "jwt" checks signature and expiry locally
+# and only loads the active tokens of the user from the db every TOKEN_ACTIVE_CACHE_TTL seconds
+TOKEN_VERIFY_MODE = environ.get("TOKEN_VERIFY_MODE", "db")
+# every worker process of src.server (WEB_WORKERS, resolved by the server) has its own token caches: a token
+# revoked by one worker (logout, update) is still accepted by the others until their entry expires.
+# The ttls bound that delay, they default to a few seconds when several workers serve the api
+# (an unset or unresolved WEB_WORKERS, 0 under plain uvicorn, means a single worker)
+_workers = max(int(environ.get("WEB_WORKERS") or 1), 1)
+TOKEN_ACTIVE_CACHE_TTL = int(environ.get("TOKEN_ACTIVE_CACHE_TTL", 30 if _workers == 1 else 5))
+TOKEN_CACHE_SIZE = int(environ.get("TOKEN_CACHE_SIZE", 10000))
+TOKEN_CACHE_TTL = int(environ.get("TOKEN_CACHE_TTL", 60 if _workers == 1 else 5))
+# unexpired tokens a user can hold, one per device: with 1 the devices of a user share its token
+# (a login returns the unexpired one), above 1 every login gets its own token and the oldest ones are revoked
+TOKEN_MAX_PER_USER = int(environ.get("TOKEN_MAX_PER_USER", 1))
+
+# verified tokens: code -> (user_id, expired_at), entries never outlive expired_at
+token_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+# active token codes per user (jwt mode): user_id -> codes
+active_tokens_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_ACTIVE_CACHE_TTL)
+register_cache("tokens", token_cache)
+register_cache("active_tokens", active_tokens_cache)
 
 #error message
 TOKEN_CREATION_ERROR_MSG = "Error while creating token"
@@ -18,21 +44,16 @@ VERIFICATION_ERROR_MSG = "Error while verifying token"
 def create_token(user):
   try:
     session = get_session()
-    unexpired_token = user_has_unexpired_token(user.id)
-    if unexpired_token:
-      return unexpired_token
+    if TOKEN_MAX_PER_USER <= 1:
+      unexpired_token = user_has_unexpired_token(user.id)
+      if unexpired_token:
+        return unexpired_token
+    # make room for the token of the new device
+    revoke_oldest_tokens(user.id, TOKEN_MAX_PER_USER - 1)
 
     # CREATE JSON TOKEN
     expires = datetime.now() + timedelta(hours=3)
-    new_token = jwt.encode({
-      "user_id": user.id,
-      "username": user.username,
-      "pseudo": user.pseudo,
-      "email": user.email,
-      "exp": expires
-    }, environ['SECRET_KEY'], algorithm="HS256")
-
-    print(environ['SECRET_KEY'])
+    new_token = encode_token(user.id, user.username, user.pseudo, user.email, expires)
 
     # add the token to the database
     token = TokenDb(
@@ -42,6 +63,7 @@ def create_token(user):
     )
     session.add(token)
     session.commit()
+    forget_active_tokens(user.id)
     return new_token
   except Exception as e:
     session.rollback()
@@ -49,24 +71,16 @@ def create_token(user):
     print(e)
     return None
 
-# This function will verify if user possess a token
+# This function will return the newest unexpired token of a user, False when it has none
+# expired tokens are left to the sweeper (see src/token_sweeper.py)
 def user_has_unexpired_token(user_id: int):
   try:
     session = get_session()
-    # construct the query to get the token
-    sql_rec = select(TokenDb).where(TokenDb.user_id == user_id)
+    # construct the query to get the token (idx_token_user_expired)
+    sql_rec = select(TokenDb.code).where(TokenDb.user_id == user_id, TokenDb.expired_at > datetime.now()).order_by(TokenDb.expired_at.desc()).limit(1)
     # execute the query and get the token
-    token = session.scalars(sql_rec).one_or_none()
-
-    # verify if token exist and is not expired
-    if token is None:
-      return False
-    if token.expired_at < datetime.now():
-      # delete the token if it is expired
-      session.delete(token)
-      session.commit()
-      return False
-    return token.code
+    code = session.scalars(sql_rec).first()
+    return code if code is not None else False
   except Exception as e:
     print("Error while verifying if user has unexpired token:")
     print(e)
@@ -81,13 +95,7 @@ def update_token(user):
     session = get_session()
     # CREATE JSON TOKEN
     expires = datetime.now() + timedelta(hours=3)
-    new_token = jwt.encode({
-      "user_id": user.id,
-      "username": user.username,
-      "pseudo": user.pseudo,
-      "email": user.email,
-      "exp": expires
-    }, environ['SECRET_KEY'], algorithm="HS256")
+    new_token = encode_token(user.id, user.username, user.pseudo, user.email, expires)
 
     # add the token to the database
     token = TokenDb(
@@ -97,6 +105,7 @@ def update_token(user):
     )
     session.add(token)
     session.commit()
+    forget_active_tokens(user.id)
     return new_token
   except Exception as e:
     session.rollback()
@@ -107,22 +116,30 @@ def update_token(user):
   
 def verify_token(token: str, user_id: int = None):
   try:
-    session = get_session()
     if token is None:
       raise ValueError(TOKEN_NOT_FOUND_MSG)
-    # construct the query to get the token
-    sql_rec = select(TokenDb).where(TokenDb.code == token)
-    if user_id is not None:
-      sql_rec = sql_rec.where(TokenDb.user_id == user_id)
-    # execute the query and get the token
-    token = session.scalars(sql_rec).one_or_none()
-
-    # verify if token exist and is not expired
-    if token is None:
+    if TOKEN_VERIFY_MODE == "jwt":
+      return verify_token_signature(token, user_id)
+
+    cached = token_cache.get(token)
+    if cached is None:
+      session = get_session()
+      # construct the query to get the token
+      sql_rec = select(TokenDb).where(TokenDb.code == token)
+      # execute the query and get the token
+      db_token = session.scalars(sql_rec).one_or_none()
+      if db_token is None:
+        raise ValueError(VERIFICATION_ERROR_MSG)
+      cached = (db_token.user_id, db_token.expired_at)
+      token_cache.set(token, cached, (db_token.expired_at - datetime.now()).total_seconds())
+
+    # verify if token belongs to the user and is not expired
+    token_user_id, expired_at = cached
+    if user_id is not None and token_user_id != user_id:
       raise ValueError(VERIFICATION_ERROR_MSG)
-    if token.expired_at < datetime.now():
+    if expired_at < datetime.now():
       raise ValueError(TOKEN_EXPIRED_MSG)
-    return token.user_id
+    return token_user_id
   except Exception as e:
     print("Error while verifying token:")
     print(e)
@@ -132,6 +149,38 @@ def verify_token(token: str, user_id: int = None):
       raise ApiException(401, 1401, [TOKEN_EXPIRED_MSG])
     raise ApiException(401, 1444, [VERIFICATION_ERROR_MSG])
 
+# Verifies the token locally (signature, expiry, user) and checks it has not been revoked
+def verify_token_signature(token: str, user_id: int = None):
+  try:
+    payload = jwt.decode(token, environ['SECRET_KEY'], algorithms=["HS256"])
+  except jwt.ExpiredSignatureError:
+    raise ValueError(TOKEN_EXPIRED_MSG)
+  except jwt.InvalidTokenError:
+    raise ValueError(VERIFICATION_ERROR_MSG)
+
+  if user_id is not None and payload.get("user_id") != user_id:
+    raise ValueError(VERIFICATION_ERROR_MSG)
+  # a token deleted from the db (logout, update) is revoked
+  if token not in get_active_tokens(payload.get("user_id")):
+    raise ValueError(VERIFICATION_ERROR_MSG)
+  return payload["user_id"]
+
+# Returns the codes of the unexpired tokens of a user, reloaded from the db once the cache entry is stale
+def get_active_tokens(user_id: int):
+  cached = active_tokens_cache.get(user_id)
+  if cached is not None:
+    return cached
+
+  session = get_session()
+  sql_rec = select(TokenDb.code).where(TokenDb.user_id == user_id, TokenDb.expired_at > datetime.now())
+  codes = frozenset(session.scalars(sql_rec).all())
+  active_tokens_cache.set(user_id, codes)
+  return codes
+
+# Drops the cached active tokens of a user, called whenever its tokens change
+def forget_active_tokens(user_id: int):
+  active_tokens_cache.delete(user_id)
+
 def delete_user_tokens(user_id: int):
   try:
     session = get_session()
@@ -145,10 +194,50 @@ def delete_user_tokens(user_id: int):
       return True
 
     for token in tokens:
+      # revoked tokens must not be served from the cache anymore
+      token_cache.delete(token.code)
       session.delete(token)
     session.commit()
+    forget_active_tokens(user_id)
     return True
   except Exception as e:
     print("Error while deleting user tokens:")
     print(e)
     return False
+
+# Revokes the tokens of a user but the keep newest ones (committed by the caller)
+def revoke_oldest_tokens(user_id: int, keep: int):
+  session = get_session()
+  sql_rec = select(TokenDb).where(TokenDb.user_id == user_id).order_by(TokenDb.expired_at.desc()).offset(max(keep, 0))
+  for token in session.scalars(sql_rec).all():
+    token_cache.delete(token.code)
+    session.delete(token)
+  forget_active_tokens(user_id)
+
+# Deletes up to batch_size expired tokens, oldest first (idx_token_expired_at), returns how many were deleted
+def delete_expired_tokens(batch_size: int):
+  session = get_session()
+  try:
+    sql_rec = select(TokenDb.id).where(TokenDb.expired_at < datetime.now()).order_by(TokenDb.expired_at).limit(batch_size)
+    ids = session.scalars(sql_rec).all()
+    if ids:
+      session.execute(delete(TokenDb).where(TokenDb.id.in_(ids)))
+      session.commit()
+    return len(ids)
+  except Exception as e:
+    session.rollback()
+    print("Error while deleting expired tokens:")
+    print(e)
+    raise
+
+############################################################## ASYNC VERSIONS ##############################################################
+# db I/O of these is awaited on the async engine, so the event loop keeps serving other requests
+
+# the verified user is recorded on the request, its writes open a read-your-writes window (see run_read_only)
+async def verify_token_async(token: str, user_id: int = None):
+  token_user_id = await run_with_session(verify_token, token, user_id)
+  set_request_user(token_user_id)
+  return token_user_id
+
+async def delete_expired_tokens_async(batch_size: int):
+  return await run_with_session(delete_expired_tokens, batch_size)
@@ -1,12 +1,16 @@
-from src.db.connection import get_session, get_base
+from src.db.connection import get_session, get_base, run_with_session, run_read_only
 from src.models import User, ApiException, Auth
 from src.validators.user import validate_user, validate_auth, validate_user_update
 from datetime import datetime
-from bcrypt import hashpw, gensalt
+from src.security import hash_password, check_password, hash_password_async, check_password_async
 from sqlalchemy import select, or_, func
 from src.controllers.token import create_token, TOKEN_CREATION_ERROR_MSG, update_token
+from src.pagination import fetch_page, cached_count, INVALID_CURSOR_MSG
+from src.search import search_filter
+from src.serializers import user_to_json, public_user_to_json
 
-UserDb = get_base().classes.user
+Base = get_base()
+UserDb = Base.classes.user
 
 #error message
 USER_NOT_FOUND_MSG = "User not found"
@@ -16,16 +20,18 @@ EMAIL_ALREADY_EXISTS_MSG = "An account with this email already exists"
 PAGE_NOT_FOUND_MSG = "Page not found"
 
 # This function will add a user to the database
-def add_user(user_data: User):
+# password_hash is the already computed hash of user_data.password (async version)
+def add_user(user_data: User, password_hash: str = None):
   session = get_session()
   validate_user(user_data)
   try:
-    user_data.password = hashpw(user_data.password.encode("utf-8"), gensalt()).decode("utf-8")
+    if password_hash is None:
+      password_hash = hash_password(user_data.password)
     user = UserDb(
       username=user_data.username,
       email=user_data.email,
       pseudo=user_data.pseudo,
-      password=user_data.password,
+      password=password_hash,
       created_at=datetime.now(),
     )
     session.add(user)
@@ -47,7 +53,9 @@ def add_user(user_data: User):
     raise ApiException(500, 1999, ["{}".format(e)])
 
 # This function will authenticate a user
-def auth_user(auth: Auth):
+# verified_hash is a password hash auth.password was already checked against (async version),
+# bcrypt is skipped only if it still is the password of the user
+def auth_user(auth: Auth, verified_hash: str = None):
   session = get_session()
   validate_auth(auth)
   try:
@@ -61,7 +69,7 @@ def auth_user(auth: Auth):
     # verify user and password
     if user is None:
       raise ValueError(USER_NOT_FOUND_MSG)
-    if hashpw(password.encode("utf-8"), user.password.encode("utf-8")) != user.password.encode("utf-8"):
+    if (verified_hash is None or verified_hash != user.password) and not check_password(password, user.password):
       raise ValueError(INVALID_PASSWORD_MSG)
     
     # create a token
@@ -113,7 +121,8 @@ def delete_user(user_id: int):
     raise ApiException(500, 1999, ["{}".format(e)])
 
 # This function will update a user in the database
-def update_user(user_id: int, user_data: User):
+# password_hash is the already computed hash of user_data.password (async version)
+def update_user(user_id: int, user_data: User, password_hash: str = None):
   session = get_session()
   validate_user_update(user_data)
   try:  
@@ -130,7 +139,8 @@ def update_user(user_id: int, user_data: User):
     user.username = user_data.username if user_data.username else user.username
     user.email = user_data.email if user_data.email else user.email
     user.pseudo = user_data.pseudo if user_data.pseudo else user.pseudo
-    user.password = hashpw(user_data.password.encode("utf-8"), gensalt()).decode("utf-8") if user_data.password else user.password
+    if user_data.password:
+      user.password = password_hash if password_hash is not None else hash_password(user_data.password)
     session.commit()
     return {
       "message": "User updated successfully",
@@ -150,36 +160,40 @@ def update_user(user_id: int, user_data: User):
     raise ApiException(500, 1999, ["{}".format(e)])
 
 # This function will get all users from the database with a pagination system
-def get_users(pseudo: str, page: int, per_page: int):
+# after (a cursor) paginates on the primary key, the total is then only counted when with_total is set
+def get_users(pseudo: str, page: int, per_page: int, after: str = None, with_total: bool = False):
   session = get_session()
   try:
     if page < 1:
       raise ValueError(PAGE_NOT_FOUND_MSG)
 
-    # get the total number of users
-    users_count = session.query(func.count(UserDb.id)).filter(UserDb.pseudo.like(f"%{pseudo}%")).scalar()
+    # search users by pseudo (full-text index when available)
+    pseudo_filter, relevance = search_filter(UserDb.pseudo, pseudo)
 
-    # calculate the offset
-    offset = ((page -1 ) * per_page)
-    if offset < 0:
-      offset = 0
+    # get the total number of users
+    users_count = None
+    if after is None or with_total:
+      users_count = cached_count(session, select(func.count(UserDb.id)).filter(pseudo_filter))
     
-    # construct the query to get the users
-    sql_rec = select(UserDb).filter(UserDb.pseudo.like(f"%{pseudo}%")).limit(per_page).offset(offset)
+    # construct the query to get the users, best matches first
+    sql_rec = select(UserDb).filter(pseudo_filter)
+    if relevance is not None and after is None:
+      sql_rec = sql_rec.order_by(relevance.desc())
 
     # execute the query and get the users
-    users = session.scalars(sql_rec).all()
+    users, next_cursor = fetch_page(session, sql_rec, UserDb.id, per_page, page, after, ranked=relevance is not None and after is None)
 
     # verify if pages exists (Page 1 always exists)
-    if (len(users) == 0 and page != 1):
+    if (len(users) == 0 and page != 1 and after is None):
       raise ValueError(PAGE_NOT_FOUND_MSG)
     
     return {
       "message": "OK",
       "data": [user_to_json(user) for user in users],
       "pager": {
-        "current": page,
+        "current": page if after is None else None,
         "total": users_count,
+        "next_cursor": next_cursor,
       },
     }
   
@@ -190,6 +204,8 @@ def get_users(pseudo: str, page: int, per_page: int):
     print(e)
     if PAGE_NOT_FOUND_MSG in str(e):
       raise ApiException(404, 1004, [PAGE_NOT_FOUND_MSG])
+    if INVALID_CURSOR_MSG in str(e):
+      raise ApiException(400, 1001, [INVALID_CURSOR_MSG])
     raise ApiException(500, 1999, ["{}".format(e)])
 
 # This function will get a user by its id from the database
@@ -217,12 +233,58 @@ def get_user_by_id(user_id: int):
       raise ApiException(404, 1004, [USER_NOT_FOUND_MSG])
     raise ApiException(500, 1999, ["{}".format(e)])
 
-# This function will convert a User object to a JSON object
-def user_to_json(user: User):
-  return None if user is None else {
-    "id": user.id,
-    "username": user.username,
-    "email": user.email,
-    "pseudo": user.pseudo,
-    "created_at": user.created_at,
-  }
+# This function will get the users with the given ids from the database, in the order of ids
+# any user can look up others, so only their public fields are returned (get_user_by_id serves the own record)
+def get_users_by_ids(ids: list):
+  session = get_session()
+  try:
+    sql_rec = select(UserDb).where(UserDb.id.in_(ids))
+    users = {user.id: user for user in session.scalars(sql_rec).all()}
+    return {
+      "message": "OK",
+      "data": [public_user_to_json(users[id]) for id in ids if id in users],
+      "not_found": [id for id in ids if id not in users],
+    }
+  except Exception as e:
+    print("Error while getting users by ids:")
+    print(e)
+    raise ApiException(500, 1999, ["{}".format(e)])
+
+# This function will return the password hash of the user matching login, None if there is none
+def get_password_hash(login: str):
+  session = get_session()
+  sql_rec = select(UserDb.password).where(or_(UserDb.username == login, UserDb.email == login))
+  return session.scalars(sql_rec).first()
+
+############################################################## ASYNC VERSIONS ##############################################################
+# db I/O of these is awaited on the async engine, so the event loop keeps serving other requests
+
+# passwords are hashed and checked in the bcrypt pool, between the db steps
+async def add_user_async(user_data: User):
+  validate_user(user_data)
+  password_hash = await hash_password_async(user_data.password)
+  return await run_with_session(add_user, user_data, password_hash)
+
+async def auth_user_async(auth: Auth):
+  validate_auth(auth)
+  password_hash = await run_with_session(get_password_hash, auth.login)
+  if password_hash is not None and not await check_password_async(auth.password, password_hash):
+    raise ApiException(401, 1103, [INVALID_PASSWORD_MSG])
+  return await run_with_session(auth_user, auth, password_hash)
+
+async def delete_user_async(user_id: int):
+  return await run_with_session(delete_user, user_id)
+
+async def update_user_async(user_id: int, user_data: User):
+  validate_user_update(user_data)
+  password_hash = await hash_password_async(user_data.password) if user_data.password else None
+  return await run_with_session(update_user, user_id, user_data, password_hash)
+
+async def get_users_async(pseudo: str, page: int, per_page: int, after: str = None, with_total: bool = False):
+  return await run_read_only(get_users, pseudo, page, per_page, after, with_total)
+
+async def get_user_by_id_async(user_id: int):
+  return await run_read_only(get_user_by_id, user_id)
+
+async def get_users_by_ids_async(ids: list):
+  return await run_read_only(get_users_by_ids, ids)
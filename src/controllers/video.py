@@ -1,17 +1,26 @@
-from sqlalchemy import select, func
-from src.db.connection import get_session, get_base
+from sqlalchemy import select, func, update, bindparam
+from sqlalchemy.orm import joinedload, selectinload
+from src.db.connection import get_session, get_base, run_in_thread, run_with_session, run_read_only
 from src.models import ApiException, VideoList
-from fastapi import UploadFile
+from src.cache import TTLCache
+from src.metrics import register_cache, UPLOADS, UPLOAD_BYTES, UPLOAD_SECONDS
+from src.pagination import fetch_page, cached_count, INVALID_CURSOR_MSG
+from src.search import search_filter
+from src.response_cache import invalidate_video
+from fastapi import Request
+from src.uploads import ReceivedFile, receive_form, publish_file, UPLOAD_TOO_LARGE, INVALID_FORM
 from src.controllers.token import verify_token
-from src.controllers.user import user_to_json
+from src.serializers import video_to_json
 from datetime import datetime
 import ffmpeg
 import os
 from math import ceil
+from time import perf_counter
 
-UserDb = get_base().classes.user
-VideoDb = get_base().classes.video
-VideoFormatDb = get_base().classes.video_format
+Base = get_base()
+UserDb = Base.classes.user
+VideoDb = Base.classes.video
+VideoFormatDb = Base.classes.video_format
 
 # error message
 USER_NOT_FOUND_MSG = "User not found"
@@ -21,6 +30,18 @@ WRONG_VIDEO_FORMAT = "Video must be in mp4 format"
 ERROR_SAVING_VIDEO = "Error while saving video"
 VIDEO_NAME_REQUIRED ="Video name is required"
 VIDEO_SOURCE_REQUIRED = "Video source is required"
+VIDEO_TOO_LARGE = "Video is too large"
+FORMAT_NOT_FOUND_MSG = "Format not found"
+FILE_NOT_FOUND_MSG = "Video file not found"
+
+# uploads are streamed to disk in chunks of this size (bytes)
+UPLOAD_CHUNK_SIZE = int(os.getenv("VIDEO_UPLOAD_CHUNK_SIZE", 1024 * 1024))
+# biggest video accepted (bytes)
+VIDEO_MAX_UPLOAD_SIZE = int(os.getenv("VIDEO_MAX_UPLOAD_SIZE", 2 * 1024 * 1024 * 1024))
+
+# ffprobe results by content hash, re-uploads of the same file skip the probe
+probe_cache = TTLCache(int(os.getenv("VIDEO_PROBE_CACHE_SIZE", 1024)), int(os.getenv("VIDEO_PROBE_CACHE_TTL", 24 * 3600)))
+register_cache("video_probes", probe_cache)
 
 # This function will return a list of videos
 def get_videos(body: VideoList):
@@ -41,58 +62,37 @@ def get_videos(body: VideoList):
         if user is None:
           raise ValueError(USER_NOT_FOUND_MSG)
     
-    sql_rec = select(VideoDb)
-    sql_rec_count = select(func.count(VideoDb.id))
-    if user is not None:
-      # search for videos of the user
-      sql_rec = sql_rec.where(VideoDb.user_id == user.id)
-      sql_rec_count = sql_rec_count.where(VideoDb.user_id == user.id)
-    if body.duration is not None and body.duration > 0:
-      # search for videos with duration between duration - 10 and duration + 10
-      sql_rec = sql_rec.where(VideoDb.duration.between(body.duration - 10, body.duration + 10))
-      sql_rec_count = sql_rec_count.where(VideoDb.duration.between(body.duration - 10, body.duration + 10))
-    if body.name is not None:
-      # search for videos with name containing the search string
-      sql_rec = sql_rec.where(VideoDb.name.like("%{}%".format(body.name)))
-      sql_rec_count = sql_rec_count.where(VideoDb.name.like("%{}%".format(body.name)))
-
-    # get total number of videos
-    try:
-      total_videos = session.scalars(sql_rec_count).first()
-    except Exception as e:
-      raise ValueError("Error while getting total videos")
+    sql_rec, sql_rec_count, ranked = videos_query(body, user.id if user is not None else None)
 
-    # calculate pagination offset
-    offset = ((body.page -1 ) * body.perPage)
-    if offset < 0:
-      offset = 0
-    
     try :
-      # limit the number of videos fetched and offset
-      sql_rec = sql_rec.limit(body.perPage).offset(offset)
-      # execute the query and get the videos
-      videos = session.scalars(sql_rec).all()
+      # fetch the page (by cursor when given, by page number otherwise)
+      videos, next_cursor = fetch_page(session, sql_rec, VideoDb.id, body.perPage, body.page, body.after, ranked=ranked)
+    except ValueError:
+      raise
     except Exception as e:
       raise ValueError("Error while fetching videos")
     
     # verify if pages exists (Page 1 always exists)
-    if (len(videos) == 0 and body.page != 1):
+    if (len(videos) == 0 and body.page != 1 and body.after is None):
       raise ValueError(PAGE_NOT_FOUND_MSG)
-    
-    total_pages = ceil(total_videos / body.perPage)    
 
-    data = []
-    for video in videos:
-      formats = session.query(VideoFormatDb).filter(VideoFormatDb.video_id == video.id).all()
-      user = session.query(UserDb).filter(UserDb.id == video.user_id).first()
-      data.append(video_to_json(video, user, formats))
+    # get total number of pages, only on demand when paginating by cursor
+    total_pages = None
+    if body.after is None or body.withTotal:
+      try:
+        total_pages = ceil(cached_count(session, sql_rec_count) / body.perPage)
+      except Exception as e:
+        raise ValueError("Error while getting total videos")
+
+    data = [video_to_json(video, video.user, video.video_format_collection) for video in videos]
     
     return {
       "message": "OK",
       "data": data,
       "pager": {
-        "current": body.page,
+        "current": body.page if body.after is None else None,
         "total": total_pages,
+        "next_cursor": next_cursor,
       }
     }
   except Exception as e:
@@ -102,6 +102,57 @@ def get_videos(body: VideoList):
       raise ApiException(404, 1004, [USER_NOT_FOUND_MSG])
     if PAGE_NOT_FOUND_MSG in str(e):
       raise ApiException(404, 1004, [PAGE_NOT_FOUND_MSG])
+    if INVALID_CURSOR_MSG in str(e):
+      raise ApiException(400, 1001, [INVALID_CURSOR_MSG])
+    raise ApiException(500, 1999, ["{}".format(e)])
+
+# Builds the listing and count statements of get_videos for the filters of body
+# and tells if the listing is ordered by relevance (such pages are paginated by page number only)
+def videos_query(body: VideoList, user_id: int = None):
+  # owners are joined and formats loaded in one extra query for the whole page
+  sql_rec = select(VideoDb).options(
+    joinedload(VideoDb.user),
+    selectinload(VideoDb.video_format_collection),
+  )
+  sql_rec_count = select(func.count(VideoDb.id))
+  ranked = False
+  if user_id is not None:
+    # search for videos of the user
+    sql_rec = sql_rec.where(VideoDb.user_id == user_id)
+    sql_rec_count = sql_rec_count.where(VideoDb.user_id == user_id)
+  if body.duration is not None and body.duration > 0:
+    # search for videos with duration between duration - 10 and duration + 10
+    sql_rec = sql_rec.where(VideoDb.duration.between(body.duration - 10, body.duration + 10))
+    sql_rec_count = sql_rec_count.where(VideoDb.duration.between(body.duration - 10, body.duration + 10))
+  if body.name is not None:
+    # search for videos with name containing the search string (full-text index when available)
+    name_filter, relevance = search_filter(VideoDb.name, body.name)
+    sql_rec = sql_rec.where(name_filter)
+    sql_rec_count = sql_rec_count.where(name_filter)
+    # best matches first, cursor pages stay ordered by id
+    if relevance is not None and body.after is None:
+      sql_rec = sql_rec.order_by(relevance.desc())
+      ranked = True
+  return sql_rec, sql_rec_count, ranked
+
+# This function will return the videos with the given ids, in the order of ids
+# owners and formats of all of them are loaded with two more queries
+def get_videos_by_ids(ids: list):
+  session = get_session()
+  try:
+    sql_rec = select(VideoDb).where(VideoDb.id.in_(ids)).options(
+      joinedload(VideoDb.user),
+      selectinload(VideoDb.video_format_collection),
+    )
+    videos = {video.id: video for video in session.scalars(sql_rec).all()}
+    return {
+      "message": "OK",
+      "data": [video_to_json(videos[id], videos[id].user, videos[id].video_format_collection) for id in ids if id in videos],
+      "not_found": [id for id in ids if id not in videos],
+    }
+  except Exception as e:
+    print("Error while getting videos by ids:")
+    print(e)
     raise ApiException(500, 1999, ["{}".format(e)])
 
 # This function will update a video
@@ -115,14 +166,16 @@ def update_video(video_id: int, name: str):
     if video is None:
       raise ValueError(VIDEO_NOT_FOUND_MSG)
 
-    # update video name
-    video.name = name
-    session.commit()
-
     # get user info
     user = session.query(UserDb).filter(UserDb.id == video.user_id).first()
     if user is None:
       raise ValueError(USER_NOT_FOUND_MSG)
+
+    # update video name
+    video.name = name
+    session.commit()
+    # listings filtered by username are tagged with it
+    invalidate_video(video.id, video.user_id, user.username, renamed=True)
     
     # get video formats
     video_formats = session.query(VideoFormatDb).filter(VideoFormatDb.video_id == video_id).all()
@@ -144,15 +197,15 @@ def update_video(video_id: int, name: str):
     raise ApiException(500, 1999, ["{}".format(e)])
 
 # This function will add a video to the user
-def add_video_to_user(user_id: int, name: str, video: UploadFile):
+# video was received by receive_video_upload, its temporary file is removed when the video is not added
+def add_video_to_user(user_id: int, name: str, video: ReceivedFile):
   session = get_session()
-  if video is None:
-    raise ValueError(VIDEO_SOURCE_REQUIRED)
-  if name is None:
-    raise ValueError(VIDEO_NAME_REQUIRED)
-  if video.content_type != "video/mp4":
-    raise ValueError(WRONG_VIDEO_FORMAT)
   try:
+    if video is None:
+      raise ValueError(VIDEO_SOURCE_REQUIRED)
+    if name is None or name == "":
+      raise ValueError(VIDEO_NAME_REQUIRED)
+
     # get user and check if it exists
     user = session.query(UserDb).filter(UserDb.id == user_id).first()
     if user is None:
@@ -160,23 +213,22 @@ def add_video_to_user(user_id: int, name: str, video: UploadFile):
     
     # save video to public directory
     video_path = save_video_public(video)
-    if video_path is None:
-      raise ValueError(ERROR_SAVING_VIDEO)
     
     # get video info (width, height, duration)
-    video_info = get_video_info(video_path)
+    video_info = get_video_info(video_path, video.sha256())
     
     video = VideoDb(
       user_id=user_id,
       name=name,
       source=video_path,
-      duration=video_info["duration"],
+      duration=video_info["duration"] if video_info is not None else None,
       views=0,
       created_at=datetime.now(),
       enabled=True
     )
     session.add(video)
     session.commit()
+    invalidate_video(video.id, user_id, user.username, membership=True)
 
     # get video formats
     video_formats = session.query(VideoFormatDb).filter(VideoFormatDb.video_id == video.id).all()
@@ -187,6 +239,8 @@ def add_video_to_user(user_id: int, name: str, video: UploadFile):
     }
   except Exception as e:
     session.rollback()
+    if video is not None:
+      video.discard()
     print("Error while adding video to db:")
     print(e)
     if USER_NOT_FOUND_MSG in str(e):
@@ -199,6 +253,8 @@ def add_video_to_user(user_id: int, name: str, video: UploadFile):
       raise ApiException(400, 1002, [VIDEO_NAME_REQUIRED])
     if VIDEO_SOURCE_REQUIRED in str(e):
       raise ApiException(400, 1002, [VIDEO_SOURCE_REQUIRED])
+    if VIDEO_TOO_LARGE in str(e):
+      raise ApiException(413, 1010, [VIDEO_TOO_LARGE])
     raise ApiException(500, 1999, ["{}".format(e)])
 
 # This function will delete a video
@@ -212,8 +268,10 @@ def delete_video(video_id: int, user_id: int):
       raise ValueError("Forbidden")
     
     # delete video
+    owner_id, owner_username = video.user.id, video.user.username
     session.delete(video)
     session.commit()
+    invalidate_video(video_id, owner_id, owner_username, membership=True)
     return {
       "message": "OK",
     }
@@ -252,6 +310,7 @@ def add_video_format(video_id: int, format: str, source: str):
     )
     session.add(video_format)
     session.commit()
+    invalidate_video(video_id, video.user_id)
 
     video_formats = session.query(VideoFormatDb).filter(VideoFormatDb.video_id == video_id).all()
     return {
@@ -272,71 +331,162 @@ def add_video_format(video_id: int, format: str, source: str):
       raise ApiException(400, 1009, ["Format already exists"])
     raise ApiException(500, 1999, ["{}".format(e)])
   
+# This function will return the path of the file of a video (or of one of its formats) to stream
+def get_video_file(video_id: int, format: str = None):
+  session = get_session()
+  try:
+    video = session.query(VideoDb).filter(VideoDb.id == video_id).first()
+    if video is None:
+      raise ValueError(VIDEO_NOT_FOUND_MSG)
+
+    uri = video.source
+    if format is not None:
+      video_format = session.query(VideoFormatDb).filter(VideoFormatDb.video_id == video_id, VideoFormatDb.code == format).first()
+      if video_format is None:
+        raise ValueError(FORMAT_NOT_FOUND_MSG)
+      uri = video_format.uri
+
+    path = public_file_path(uri)
+    if path is None or not os.path.isfile(path):
+      raise ValueError(FILE_NOT_FOUND_MSG)
+    return path
+  except Exception as e:
+    print("Error while getting video file:")
+    print(e)
+    if VIDEO_NOT_FOUND_MSG in str(e):
+      raise ApiException(404, 1005, [VIDEO_NOT_FOUND_MSG])
+    if FORMAT_NOT_FOUND_MSG in str(e):
+      raise ApiException(404, 1004, [FORMAT_NOT_FOUND_MSG])
+    if FILE_NOT_FOUND_MSG in str(e):
+      raise ApiException(404, 1004, [FILE_NOT_FOUND_MSG])
+    raise ApiException(500, 1999, ["{}".format(e)])
+  
+# This function will add buffered views to the videos, batch is {video_id: views}
+def add_video_views(batch: dict):
+  session = get_session()
+  try:
+    video_table = VideoDb.__table__
+    sql_rec = (
+      update(video_table)
+      .where(video_table.c.id == bindparam("video_id"))
+      .values(views=video_table.c.views + bindparam("count"))
+    )
+    # one executemany for the whole batch
+    session.execute(sql_rec, [{"video_id": video_id, "count": count} for video_id, count in batch.items()])
+    session.commit()
+  except Exception:
+    session.rollback()
+    raise
+
 ############################################################## HELPER FUNCTIONS ##############################################################
 
-def video_to_json(video, user, video_format=None):
-  return {} if video is None else {
-    "id": video.id,
-    "name": video.name,
-    "source": video.source,
-    "created_at": video.created_at,
-    "views": video.views,
-    "enabled": video.enabled,
-    "user": {
-      "id": user.id,
-      "username": user.username,
-      "pseudo": user.pseudo,
-      "created_at": user.created_at
-    },
-    "format": format_to_json(video_format)
-  }
-
-def format_to_json(video_format):
-  formats = {}
-  for f in video_format:
-    formats[f.code] = f.uri
-  return formats
-
-# Saves video received from the user to the public directory
-# Returns the path to the saved video
-def save_video_public(video: UploadFile) -> str:
-  public_video_path = "{}/public/videos/".format(os.getcwd())
+# Resolves a stored uri (absolute path or relative to public/) to a file of the public directory
+# Returns None for anything outside of it
+def public_file_path(uri: str):
+  public_path = os.path.realpath("{}/public".format(os.getcwd()))
+  path = os.path.realpath(os.path.join(public_path, uri))
+  if os.path.commonpath([public_path, path]) != public_path:
+    return None
+  return path
 
-  # create video directory
+# Directory of the uploaded videos, created when missing
+def public_video_directory() -> str:
+  public_video_path = "{}/public/videos/".format(os.getcwd())
   try:
-    if not os.path.exists(public_video_path):
-      os.makedirs(public_video_path)
+    os.makedirs(public_video_path, exist_ok=True)
   except Exception:
     raise ApiException(500, 1999, ["Error while creating video directory"])
-  
-  # check if video already exists
+  return public_video_path
+
+# Streams the body of an upload request (multipart: name and source) to the public directory
+# the source is refused before it is written when it is not an mp4 or too big (see src/uploads.py)
+# Returns the name and the received source (None when missing)
+async def receive_video_upload(request: Request):
+  def accept_file(field: str, filename: str, content_type: str):
+    if field != "source" or filename == "":
+      raise ValueError(VIDEO_SOURCE_REQUIRED)
+    if content_type != "video/mp4":
+      raise ValueError(WRONG_VIDEO_FORMAT)
+
+  started = perf_counter()
   try:
-    if os.path.exists("{}{}".format(public_video_path, video.filename)):
-      video.filename = "{}_{}".format(datetime.now().strftime("%Y%m%d%H%M%S"), video.filename)
-  except Exception:
-    raise ApiException(500, 1999, ["Error while checking video existence"])
-  
+    fields, files = await receive_form(request, public_video_directory(), VIDEO_MAX_UPLOAD_SIZE, accept_file, UPLOAD_CHUNK_SIZE)
+  except ApiException:
+    raise
+  except Exception as e:
+    print("Error while receiving video:")
+    print(e)
+    if UPLOAD_TOO_LARGE in str(e):
+      raise ApiException(413, 1010, [VIDEO_TOO_LARGE])
+    if WRONG_VIDEO_FORMAT in str(e):
+      raise ApiException(400, 1003, [WRONG_VIDEO_FORMAT])
+    if VIDEO_SOURCE_REQUIRED in str(e) or INVALID_FORM in str(e):
+      raise ApiException(400, 1002, [VIDEO_SOURCE_REQUIRED])
+    raise ApiException(500, 1999, [ERROR_SAVING_VIDEO])
+  video = files.get("source")
+  if video is not None:
+    UPLOAD_SECONDS.observe(perf_counter() - started)
+  return fields.get("name"), video
+
+# Moves a received video to its final name in the public directory, returns its path
+def save_video_public(video: ReceivedFile):
   try:
-    with open("{}{}".format(public_video_path, video.filename), "wb") as buffer:
-      buffer.write(video.file.read())
+    path = publish_file(video.path, public_video_directory(), video.filename)
   except Exception:
     raise ApiException(500, 1999, ["Error while saving video"])
-
-  return "{}{}".format(public_video_path, video.filename)
+  UPLOADS.inc()
+  UPLOAD_BYTES.inc(amount=video.size)
+  return path
 
 # This function meta data of a video
-def get_video_info(path):
+# results are cached by content hash when it is given
+def get_video_info(path, content_hash: str = None):
+  if content_hash is not None:
+    video_info = probe_cache.get(content_hash)
+    if video_info is not None:
+      return video_info
   try:
     probe = ffmpeg.probe(path)
     video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
     if video_stream is None:
       return None
-    return {
+    video_info = {
       "width": video_stream['width'],
       "height": video_stream['height'],
       "duration": video_stream['duration']
     }
+    if content_hash is not None:
+      probe_cache.set(content_hash, video_info)
+    return video_info
   except Exception as e:
     print("Error while getting video info:")
     print(e)
     return None
+
+############################################################## ASYNC VERSIONS ##############################################################
+# db I/O of these is awaited on the async engine, so the event loop keeps serving other requests
+
+async def get_videos_async(body: VideoList):
+  return await run_read_only(get_videos, body)
+
+async def update_video_async(video_id: int, name: str):
+  return await run_with_session(update_video, video_id, name)
+
+# runs in the threadpool: streaming the upload to disk and ffprobe must stay off the event loop
+async def add_video_to_user_async(user_id: int, name: str, video: ReceivedFile):
+  return await run_in_thread(add_video_to_user, user_id, name, video)
+
+async def delete_video_async(video_id: int, user_id: int):
+  return await run_with_session(delete_video, video_id, user_id)
+
+async def add_video_format_async(video_id: int, format: str, source: str):
+  return await run_with_session(add_video_format, video_id, format, source)
+
+async def get_video_file_async(video_id: int, format: str = None):
+  return await run_with_session(get_video_file, video_id, format)
+
+async def add_video_views_async(batch: dict):
+  return await run_with_session(add_video_views, batch)
+
+async def get_videos_by_ids_async(ids: list):
+  return await run_read_only(get_videos_by_ids, ids)
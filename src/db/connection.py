@@ -1,7 +1,17 @@
+import hashlib
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import pickle
+from contextvars import ContextVar
+from itertools import count
+from time import perf_counter
+from sqlalchemy import create_engine, MetaData, event, text
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.automap import automap_base
+from fastapi.concurrency import run_in_threadpool
+from src.metrics import DB_POOL_CHECKOUT_SECONDS, register_pool
+from src.cache import TTLCache
 
 
 # Get environment variables
@@ -11,8 +21,32 @@ user = os.getenv("DB_USER", "user")
 password = os.getenv("DB_PASSWORD", "password")
 db = os.getenv("DB_NAME", "mydb")
 
-# Create the database URL
-db_url = "mysql+pymysql://{}:{}@{}:{}/{}".format(
+# Connection pool settings
+pool_size = int(os.getenv("DB_POOL_SIZE", 5))
+pool_max_overflow = int(os.getenv("DB_POOL_MAX_OVERFLOW", 10))
+pool_timeout = int(os.getenv("DB_POOL_TIMEOUT", 30))
+pool_recycle = int(os.getenv("DB_POOL_RECYCLE", 1800))
+pool_pre_ping = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+# Optional file holding a pickled snapshot of the reflected schema, ignored once the migrations of initdb/ changed
+schema_snapshot_path = os.getenv("DB_SCHEMA_SNAPSHOT", "")
+# also compares the snapshot with the live schema on every start (one or two information_schema queries),
+# off by default: run python -m src.db.snapshot --check in the deploy step instead
+schema_snapshot_verify = os.getenv("DB_SCHEMA_SNAPSHOT_VERIFY", "false").lower() in ("1", "true", "yes")
+# the migrations the snapshots are checked against
+MIGRATIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "initdb")
+
+# Create the database URL (DB_URL overrides it, e.g. sqlite:///./test.db for tests)
+db_url = os.getenv("DB_URL") or "mysql+pymysql://{}:{}@{}:{}/{}".format(
+  user,
+  password,
+  host,
+  port,
+  db
+)
+
+# Async database URL, used by the async versions of the controllers
+db_async_url = os.getenv("DB_ASYNC_URL") or "mysql+aiomysql://{}:{}@{}:{}/{}".format(
   user,
   password,
   host,
@@ -20,40 +54,353 @@ db_url = "mysql+pymysql://{}:{}@{}:{}/{}".format(
   db
 )
 
-# Function to get a connection to the database
+# Async engine is used unless disabled or the sync url points to sqlite (sync fallback)
+db_async = os.getenv("DB_ASYNC", "true").lower() in ("1", "true", "yes") and not db_url.startswith("sqlite")
+
+# Read replicas (comma separated urls), used by the read-only controllers through run_read_only
+# the async urls default to the sync ones with the aiomysql driver
+db_replica_urls = [url.strip() for url in os.getenv("DB_REPLICA_URLS", "").split(",") if url.strip()]
+db_replica_async_urls = [url.strip() for url in os.getenv("DB_REPLICA_ASYNC_URLS", "").split(",") if url.strip()] \
+  or [url.replace("mysql+pymysql://", "mysql+aiomysql://") for url in db_replica_urls]
+# after a write, the reads of the same user go to the primary for this many seconds (replication lag)
+read_your_writes_window = int(os.getenv("DB_READ_YOUR_WRITES_WINDOW", 5))
+
+# Process-wide engines and session factories, created on first use
+_engine = None
+_session_factory = None
+_async_engine = None
+_async_session_factory = None
+_replica_session_factories = None
+_replica_async_session_factories = None
+_replica_turn = count()
+
+# Holds the session of the request being served (set by db_session)
+# and the id of the user it is authenticated as (set by set_request_user)
+_request_scope = ContextVar("request_scope", default=None)
+
+# users who wrote to the primary less than read_your_writes_window seconds ago (per worker)
+recent_writers = TTLCache(int(os.getenv("DB_RECENT_WRITERS_SIZE", 10000)), read_your_writes_window)
+
+# Pools timing the wait for a free connection (db_pool_checkout_wait_seconds)
+class TimedQueuePool(QueuePool):
+  engine_label = "sync"
+
+  def _do_get(self):
+    started = perf_counter()
+    try:
+      return super()._do_get()
+    finally:
+      DB_POOL_CHECKOUT_SECONDS.observe(perf_counter() - started, self.engine_label)
+
+class TimedAsyncQueuePool(AsyncAdaptedQueuePool):
+  engine_label = "async"
+
+  def _do_get(self):
+    started = perf_counter()
+    try:
+      return super()._do_get()
+    finally:
+      DB_POOL_CHECKOUT_SECONDS.observe(perf_counter() - started, self.engine_label)
+
+# Function to get the engine of the database (one pooled engine per process)
 def get_engine():
+  global _engine
+  if _engine is not None:
+    return _engine
   try:
-    engine = create_engine(db_url)
-    print("Connection successful")
-    return engine
+    if db_url.startswith("sqlite"):
+      # sqlite picks its own pool, connections may be used from the threadpool
+      _engine = create_engine(db_url, connect_args={"check_same_thread": False})
+    else:
+      _engine = create_engine(db_url, poolclass=TimedQueuePool, **pool_options())
+      register_pool("sync", _engine.pool)
+    return _engine
   except Exception as e:
     print("Failed while creating db engine:")
     print(e)
     return None
 
+# Function to get the async engine of the database (one pooled engine per process)
+def get_async_engine():
+  global _async_engine
+  if _async_engine is None:
+    _async_engine = create_async_engine(db_async_url, poolclass=TimedAsyncQueuePool, **pool_options())
+    register_pool("async", _async_engine.pool)
+  return _async_engine
+
+# Pool settings shared by every engine of the process
+def pool_options():
+  return {
+    "pool_size": pool_size,
+    "max_overflow": pool_max_overflow,
+    "pool_timeout": pool_timeout,
+    "pool_recycle": pool_recycle,
+    "pool_pre_ping": pool_pre_ping,
+  }
+
+# Function to get the session factory bound to the process engine
+def get_session_factory():
+  global _session_factory
+  if _session_factory is None:
+    _session_factory = sessionmaker(autocommit=False, autoflush=False, bind=get_engine())
+  return _session_factory
+
 # Function to get a session to the database using SQLAlchemy ORM
+# Inside a request the same session is returned on every call and closed by db_session,
+# outside of a request (scripts, shell) the caller owns the returned session
 def get_session():
-  print("Establishing session with db...")
   try:
-    session_local = sessionmaker(autocommit=False, autoflush=False, bind=get_engine())
-    print("Connection successful")
-    return session_local()
+    scope = _request_scope.get()
+    if scope is None:
+      return get_session_factory()()
+    if scope.get("session") is None:
+      scope["session"] = get_session_factory()()
+    return scope["session"]
   except Exception as e:
     print("Error loading db session:")
     print(e)
     print("Retrying...")
     return get_session()
 
+# Function to get the async session factory bound to the process async engine
+def get_async_session_factory():
+  global _async_session_factory
+  if _async_session_factory is None:
+    _async_session_factory = async_sessionmaker(autocommit=False, autoflush=False, bind=get_async_engine())
+  return _async_session_factory
+
+# Runs a sync controller function with its db I/O awaited on the async engine
+# get_session() returns the sync facade of the async session while fn runs
+# falls back to the threadpool and the request session when the async engine is disabled
+async def run_with_session(fn, *args, **kwargs):
+  if not db_async:
+    if _request_scope.get() is None:
+      # background work (no request session): own a session for the call
+      return await run_in_threadpool(_call_with_new_session, fn, args, kwargs)
+    return await run_in_threadpool(fn, *args, **kwargs)
+  async with get_async_session_factory()() as async_session:
+    return await async_session.run_sync(_call_with_session, fn, args, kwargs)
+
+# Same as run_with_session for read-only controller functions: they run on the next replica (round robin)
+# unless there is no replica, or the user of the request wrote to the primary within the read-your-writes window
+async def run_read_only(fn, *args, **kwargs):
+  if not db_replica_urls or reads_from_primary():
+    return await run_with_session(fn, *args, **kwargs)
+  turn = next(_replica_turn)
+  if not db_async:
+    factories = get_replica_session_factories()
+    return await run_in_threadpool(_call_with_new_session, fn, args, kwargs, factories[turn % len(factories)])
+  factories = get_replica_async_session_factories()
+  async with factories[turn % len(factories)]() as async_session:
+    return await async_session.run_sync(_call_with_session, fn, args, kwargs)
+
+# Records the user the request is authenticated as, for the read-your-writes routing
+def set_request_user(user_id: int):
+  scope = _request_scope.get()
+  if scope is not None:
+    scope["user_id"] = user_id
+
+# Sends the read-only controllers of the request to the primary, e.g. to fill a cache right after a write
+def read_from_primary():
+  scope = _request_scope.get()
+  if scope is not None:
+    scope["primary"] = True
+
+def reads_from_primary() -> bool:
+  scope = _request_scope.get()
+  if scope is None:
+    return False
+  if scope.get("primary"):
+    return True
+  return scope.get("user_id") is not None and recent_writers.get(scope["user_id"]) is not None
+
+# Any flush of a request session is a write to the primary: the user starts a read-your-writes window
+@event.listens_for(Session, "after_flush")
+def _record_writer(session, flush_context):
+  scope = _request_scope.get()
+  if scope is not None and scope.get("user_id") is not None and read_your_writes_window > 0:
+    recent_writers.set(scope["user_id"], True)
+
+# Sync and async session factories of the replicas, one pooled engine per replica
+def get_replica_session_factories():
+  global _replica_session_factories
+  if _replica_session_factories is None:
+    factories = []
+    for index, url in enumerate(db_replica_urls):
+      if url.startswith("sqlite"):
+        engine = create_engine(url, connect_args={"check_same_thread": False})
+      else:
+        engine = create_engine(url, poolclass=TimedQueuePool, **pool_options())
+        register_pool("replica-{}".format(index), engine.pool)
+      factories.append(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+    _replica_session_factories = factories
+  return _replica_session_factories
+
+def get_replica_async_session_factories():
+  global _replica_async_session_factories
+  if _replica_async_session_factories is None:
+    factories = []
+    for index, url in enumerate(db_replica_async_urls):
+      engine = create_async_engine(url, poolclass=TimedAsyncQueuePool, **pool_options())
+      register_pool("replica-async-{}".format(index), engine.pool)
+      factories.append(async_sessionmaker(autocommit=False, autoflush=False, bind=engine))
+    _replica_async_session_factories = factories
+  return _replica_async_session_factories
+
+# Runs a controller function with blocking work other than db I/O (hashing, files) in the threadpool
+async def run_in_thread(fn, *args, **kwargs):
+  if _request_scope.get() is None:
+    return await run_in_threadpool(_call_with_new_session, fn, args, kwargs)
+  return await run_in_threadpool(fn, *args, **kwargs)
+
+def _call_with_session(session, fn, args, kwargs):
+  outer = _request_scope.get()
+  token = _request_scope.set({"session": session, "user_id": outer.get("user_id") if outer is not None else None})
+  try:
+    return fn(*args, **kwargs)
+  finally:
+    _request_scope.reset(token)
+
+def _call_with_new_session(fn, args, kwargs, session_factory=None):
+  session = (session_factory or get_session_factory())()
+  try:
+    return _call_with_session(session, fn, args, kwargs)
+  finally:
+    session.close()
+
+# Closes the pooled connections of the process engines (app shutdown)
+async def dispose_engines():
+  global _async_engine, _async_session_factory, _replica_session_factories, _replica_async_session_factories
+  if _async_engine is not None:
+    await _async_engine.dispose()
+    _async_engine = None
+    _async_session_factory = None
+  if _engine is not None:
+    _engine.dispose()
+  for factory in _replica_async_session_factories or []:
+    await factory.kw["bind"].dispose()
+  for factory in _replica_session_factories or []:
+    factory.kw["bind"].dispose()
+  _replica_session_factories = None
+  _replica_async_session_factories = None
+
+# Drops the connections inherited from the parent process after a fork (prefork server, see src/server.py):
+# the pools are recreated without closing the sockets, which still belong to the parent
+def reset_engines_after_fork():
+  global _async_engine, _async_session_factory, _replica_session_factories, _replica_async_session_factories
+  if _engine is not None:
+    _engine.dispose(close=False)
+    register_pool("sync", _engine.pool)
+  if _async_engine is not None:
+    _async_engine.sync_engine.dispose(close=False)
+    _async_engine = None
+    _async_session_factory = None
+  for factory in _replica_session_factories or []:
+    factory.kw["bind"].dispose(close=False)
+  for factory in _replica_async_session_factories or []:
+    factory.kw["bind"].sync_engine.dispose(close=False)
+  _replica_session_factories = None
+  _replica_async_session_factories = None
+
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=reset_engines_after_fork)
+
+# FastAPI dependency opening a request scoped session, closed once the request is served
+async def db_session():
+  scope = {}
+  _request_scope.set(scope)
+  try:
+    yield
+  finally:
+    session = scope.pop("session", None)
+    if session is not None:
+      session.close()
+
+# Reflected automap base, shared by every controller of the process
+_base = None
+
 # Function to get the base of the database
+# The schema is reflected once per process, or loaded from DB_SCHEMA_SNAPSHOT when the file exists
 def get_base():
+  global _base
+  if _base is not None:
+    return _base
   print("Establishing base builder with db...")
   try:
-    Base = automap_base()
-    Base.prepare(get_engine(), reflect=True)
+    metadata = load_schema_snapshot(schema_snapshot_path)
+    if metadata is not None:
+      Base = automap_base(metadata=metadata)
+      Base.prepare()
+    else:
+      Base = automap_base()
+      Base.prepare(autoload_with=get_engine())
     print("Connection successful")
-    return Base
+    _base = Base
+    return _base
   except Exception as e:
     print("Error loading db base:")
     print(e)
     print("Retrying...")
     return get_base()
+
+# Loads the reflected metadata saved by dump_schema_snapshot, None if there is no snapshot
+# or if it was taken with other migrations (e.g. before a new one and make migrate). Without
+# DB_SCHEMA_SNAPSHOT_VERIFY the db is not queried: the migrations are compared with the files of initdb/
+def load_schema_snapshot(path: str):
+  if not path or not os.path.exists(path):
+    return None
+  try:
+    with open(path, "rb") as snapshot:
+      saved = pickle.load(snapshot)
+    if not isinstance(saved, dict) or saved.get("migrations") != migrations_fingerprint() or (schema_snapshot_verify and saved.get("schema") != schema_fingerprint()):
+      print("Schema snapshot {} does not match the db schema, falling back to reflection (regenerate it with python -m src.db.snapshot)".format(path))
+      return None
+    return saved["metadata"]
+  except Exception as e:
+    print("Error loading schema snapshot, falling back to reflection:")
+    print(e)
+    return None
+
+# Reflects the database schema and saves it to path so workers can start without introspecting the db
+def dump_schema_snapshot(path: str):
+  metadata = MetaData()
+  metadata.reflect(bind=get_engine())
+  tmp_path = "{}.tmp".format(path)
+  with open(tmp_path, "wb") as snapshot:
+    pickle.dump({"migrations": migrations_fingerprint(), "schema": schema_fingerprint(), "metadata": metadata}, snapshot)
+  os.replace(tmp_path, path)
+  return metadata
+
+# Tells if the snapshot at path matches the live schema of the db (deploy check)
+def schema_snapshot_matches(path: str) -> bool:
+  with open(path, "rb") as snapshot:
+    saved = pickle.load(snapshot)
+  return isinstance(saved, dict) and saved.get("schema") == schema_fingerprint()
+
+# Hash of the names and contents of the migrations (initdb/*.sql), None when they are not shipped
+def migrations_fingerprint():
+  if not os.path.isdir(MIGRATIONS_PATH):
+    return None
+  digest = hashlib.sha256()
+  for name in sorted(os.listdir(MIGRATIONS_PATH)):
+    if name.endswith(".sql"):
+      digest.update(name.encode("utf-8"))
+      with open(os.path.join(MIGRATIONS_PATH, name), "rb") as migration:
+        digest.update(migration.read())
+  return digest.hexdigest()
+
+# Hash of the tables, columns and indexes of the db, read with one or two queries (much cheaper than a reflection)
+def schema_fingerprint() -> str:
+  with get_engine().connect() as connection:
+    if connection.dialect.name == "sqlite":
+      rows = connection.execute(text("SELECT type, name, tbl_name, sql FROM sqlite_master ORDER BY type, name")).all()
+    else:
+      rows = connection.execute(text(
+        "SELECT table_name, column_name, column_type, is_nullable, column_default FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() ORDER BY table_name, ordinal_position"
+      )).all()
+      rows += connection.execute(text(
+        "SELECT table_name, index_name, seq_in_index, column_name, non_unique FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() ORDER BY table_name, index_name, seq_in_index"
+      )).all()
+  return hashlib.sha256(repr([tuple(row) for row in rows]).encode("utf-8")).hexdigest()
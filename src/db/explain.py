@@ -0,0 +1,79 @@
+import sys
+from sqlalchemy import select, func, or_, text
+from sqlalchemy.orm import joinedload
+from src.db.connection import get_engine
+from src.models import VideoList
+from src.pagination import page_statement, encode_cursor
+from src.search import search_filter
+from src.controllers.token import TokenDb
+from src.controllers.user import UserDb
+from src.controllers.video import VideoDb, VideoFormatDb, videos_query
+from src.controllers.comment import CommentDb
+
+# Runs EXPLAIN on every query shape emitted by the controllers and fails when one of them scans a whole table
+# usage: python -m src.db.explain   (run it against a db seeded with realistic volumes,
+# on near empty tables the optimizer may prefer full scans)
+
+# filters combinations of get_videos: (label, VideoList fields, user_id)
+VIDEO_FILTERS = [
+  ("all", {}, None),
+  ("user", {}, 1),
+  ("duration", {"duration": 60}, None),
+  ("user+duration", {"duration": 60}, 1),
+  ("name", {"name": "music"}, None),
+  ("user+name", {"name": "music"}, 1),
+  ("user+duration+name", {"name": "music", "duration": 60}, 1),
+]
+
+# Returns the (label, statement) of every query shape
+def query_shapes():
+  shapes = []
+  for label, filters, user_id in VIDEO_FILTERS:
+    sql_rec, sql_rec_count, _ = videos_query(VideoList(**filters), user_id)
+    shapes.append(("videos[{}] page".format(label), page_statement(sql_rec, VideoDb.id, 5, page=3)))
+    shapes.append(("videos[{}] count".format(label), sql_rec_count))
+    sql_rec, _, _ = videos_query(VideoList(after=encode_cursor(1), **filters), user_id)
+    shapes.append(("videos[{}] cursor".format(label), page_statement(sql_rec, VideoDb.id, 5, after=encode_cursor(1))))
+
+  pseudo_filter, _ = search_filter(UserDb.pseudo, "killux")
+  comments_query = select(CommentDb).where(CommentDb.video_id == 1).options(joinedload(CommentDb.user))
+  shapes += [
+    ("video formats of a page", select(VideoFormatDb).where(VideoFormatDb.video_id.in_([1, 2, 3]))),
+    ("video format by code", select(VideoFormatDb).where(VideoFormatDb.video_id == 1, VideoFormatDb.code == "720")),
+    ("video by id", select(VideoDb).where(VideoDb.id == 1)),
+    ("user by id", select(UserDb).where(UserDb.id == 1)),
+    ("user by username", select(UserDb).where(UserDb.username == "killux")),
+    ("user login", select(UserDb).where(or_(UserDb.username == "killux", UserDb.email == "killux@mail.com"))),
+    ("users by pseudo", page_statement(select(UserDb).where(pseudo_filter), UserDb.id, 5)),
+    ("users by pseudo count", select(func.count(UserDb.id)).where(pseudo_filter)),
+    ("comments of video", page_statement(comments_query, CommentDb.id, 5, descending=True)),
+    ("comments of video cursor", page_statement(comments_query, CommentDb.id, 5, after=encode_cursor(100), descending=True)),
+    ("token by code", select(TokenDb).where(TokenDb.code == "code")),
+    ("tokens of user", select(TokenDb).where(TokenDb.user_id == 1)),
+    ("active tokens of user", select(TokenDb.code).where(TokenDb.user_id == 1, TokenDb.expired_at > func.now())),
+    ("newest token of user", select(TokenDb.code).where(TokenDb.user_id == 1, TokenDb.expired_at > func.now()).order_by(TokenDb.expired_at.desc()).limit(1)),
+    ("expired tokens batch", select(TokenDb.id).where(TokenDb.expired_at < func.now()).order_by(TokenDb.expired_at).limit(1000)),
+  ]
+  return shapes
+
+# Returns the plan rows of statement
+def explain(connection, statement):
+  sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+  # colons of the literals must not be read as bind parameters
+  return connection.execute(text("EXPLAIN " + sql.replace(":", "\\:"))).mappings().all()
+
+if __name__ == "__main__":
+  full_scans = []
+  with get_engine().connect() as connection:
+    for label, statement in query_shapes():
+      for row in explain(connection, statement):
+        print("{:<36}{:<16}{:<10}{:<40}{}".format(label, str(row["table"]), str(row["type"]), str(row["key"]), row["Extra"] or ""))
+        if row["type"] == "ALL":
+          full_scans.append("{} ({})".format(label, row["table"]))
+
+  if full_scans:
+    print("\nFull table scans:")
+    for full_scan in full_scans:
+      print("  - {}".format(full_scan))
+    sys.exit(1)
+  print("\nNo full table scan")
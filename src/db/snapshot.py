@@ -0,0 +1,20 @@
+import sys
+from src.db.connection import dump_schema_snapshot, schema_snapshot_matches, schema_snapshot_path
+
+# Writes the reflected schema of the database to a snapshot file
+# usage: python -m src.db.snapshot [--check] [path]   (defaults to DB_SCHEMA_SNAPSHOT)
+# --check compares the snapshot with the live schema instead, exits with 1 when it is stale (deploy step)
+if __name__ == "__main__":
+  args = [arg for arg in sys.argv[1:] if arg != "--check"]
+  path = args[0] if args else schema_snapshot_path
+  if not path:
+    print("usage: python -m src.db.snapshot [--check] <path> (or set DB_SCHEMA_SNAPSHOT)")
+    sys.exit(1)
+  if "--check" in sys.argv[1:]:
+    if not schema_snapshot_matches(path):
+      print("Schema snapshot {} does not match the db schema, regenerate it with python -m src.db.snapshot".format(path))
+      sys.exit(1)
+    print("Schema snapshot {} matches the db schema".format(path))
+    sys.exit(0)
+  metadata = dump_schema_snapshot(path)
+  print("Schema snapshot written to {} ({} tables)".format(path, len(metadata.tables)))
@@ -1,13 +1,36 @@
-from fastapi import FastAPI, Request, Form, File, UploadFile, Path, Header
-from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Path, Header, Depends
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from src.controllers.user import add_user, auth_user, delete_user, update_user, get_users, get_user_by_id
-from src.controllers.token import verify_token
-from src.controllers.video import add_video_to_user, get_videos, update_video, delete_video, add_video_format
-from src.controllers.comment import add_comment_to_video, get_comments_of_video
+from src.controllers.user import add_user_async, auth_user_async, delete_user_async, update_user_async, get_users_async, get_user_by_id_async, get_users_by_ids_async
+from src.controllers.token import verify_token_async, delete_expired_tokens_async
+from src.controllers.video import add_video_to_user_async, receive_video_upload, get_videos_async, update_video_async, delete_video_async, add_video_format_async, get_video_file_async, add_video_views_async, get_videos_by_ids_async
+from src.controllers.comment import add_comment_to_video_async, get_comments_of_video_async
+from src.db.connection import db_session, dispose_engines
+from src.responses import RangeFileResponse, fast_json
+from src.response_cache import cached_video_list
+from src.transcoding import start_transcoding, stop_transcoding, enqueue_video
+from src.views import start_view_counter, stop_view_counter, record_view
+from src.token_sweeper import start_token_sweeper, stop_token_sweeper
+from src.validators.batch import validate_ids
+from src.metrics import METRICS_ENABLED, MetricsMiddleware, CONTENT_TYPE, render
+from src.profiling import profiling_enabled, ProfilingMiddleware
 from src.models import User, Auth,ApiException, GetUsersItem, VideoList, BodyVideoListByUser, BodyVideoUpdate, BodyAddComment, BodyListComments, BodyAddFormat
 
-app = FastAPI()
+# starts the background workers (transcoding, views, expired tokens), on shutdown flushes the buffered views and releases the workers and db connections
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_transcoding(add_video_format_async)
+    await start_view_counter(add_video_views_async)
+    await start_token_sweeper(delete_expired_tokens_async)
+    yield
+    await stop_token_sweeper()
+    await stop_view_counter()
+    await stop_transcoding()
+    await dispose_engines()
+
+# every request gets its own db session, closed once the response is sent
+app = FastAPI(lifespan=lifespan, dependencies=[Depends(db_session)])
 
 # CORS Middleware
 app.add_middleware(
@@ -18,6 +41,14 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+# SQL statements of the request in a Server-Timing header (opt-in) and the slow query log
+if profiling_enabled():
+    app.add_middleware(ProfilingMiddleware)
+
+# Request counts and latencies for /metrics (outermost, so it times the whole stack)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 # Exception handler
 @app.exception_handler(Exception)
 async def exception_handler(request: Request, exc: ApiException):
@@ -38,21 +69,28 @@ async def root():
         "message": "Hello World",
     }
 
+# This route exposes the metrics of the worker in the Prometheus text format
+@app.get("/metrics", include_in_schema=False)
+async def metrics_route():
+    if not METRICS_ENABLED:
+        return Response(status_code=404)
+    return Response(content=render(), media_type=CONTENT_TYPE)
+
 # This route will add a user to the database
 @app.post("/user", status_code=201)
 async def add_user_route(user: User):
-    return add_user(user)
+    return await add_user_async(user)
 
 # This route will authenticate a user
 @app.post("/auth", status_code=201)
 async def auth_route(auth: Auth):
     # This is a dummy function that will always return a 401
-    return auth_user(auth)
+    return await auth_user_async(auth)
 
 # This route will verify the token sent in the Authorization header
 @app.get("/auth", status_code=200)
 async def auth_route(request: Request):
-    user_id = verify_token(request.headers.get("Authorization"))
+    user_id = await verify_token_async(request.headers.get("Authorization"))
     return {
         "message": "Token is valid",
         "data": {
@@ -63,69 +101,123 @@ async def auth_route(request: Request):
 # This route will delete a user from the database
 @app.delete("/user/{id}", status_code=204)
 async def delete_user_route(id: int, request: Request):
-    verify_token(request.headers.get("Authorization"), id)
-    return delete_user(id)
+    await verify_token_async(request.headers.get("Authorization"), id)
+    return await delete_user_async(id)
 
 # This route will update a user in the database
 @app.put("/user/{id}", status_code=200)
 async def update_user_route(id: int, user: User, request: Request):
-    verify_token(request.headers.get("Authorization"), id)
-    return update_user(id, user)
+    await verify_token_async(request.headers.get("Authorization"), id)
+    return await update_user_async(id, user)
 
 # This route will get a user from the database
 @app.get("/users", status_code=200)
 async def get_users_route(body: GetUsersItem):
-    return get_users(body.pseudo, body.page, body.perPage)
+    return fast_json(await get_users_async(body.pseudo, body.page, body.perPage, body.after, body.withTotal))
+
+# This route will get many users by id in one request (?ids=1,2,3)
+@app.get("/users/batch", status_code=200)
+async def get_users_batch_route(request: Request, ids: str = ''):
+    await verify_token_async(request.headers.get("Authorization"))
+    return fast_json(await get_users_by_ids_async(validate_ids(ids)))
 
 # This route will get a user from the database by id
 @app.get("/user/{user_id}", status_code=200)
 async def get_user_by_id_route(user_id: int, request: Request):
     print(request.headers.get("Authorization"))
-    verify_token(request.headers.get("Authorization"), user_id)
-    return get_user_by_id(user_id)
-
-# This route will add a video to the user
-@app.post("/user/{user_id}/video", status_code=201)
-async def add_video_to_user_route(user_id: int = Path(...), Authorization: str = Header(...), name: str = Form(...), source: UploadFile = File(...)):
-    verify_token(Authorization, user_id)
-    return add_video_to_user(user_id, name, source)
-
-# This route will get a list of videos
+    await verify_token_async(request.headers.get("Authorization"), user_id)
+    return await get_user_by_id_async(user_id)
+
+# the upload form is read by receive_video_upload, documented here for /docs
+UPLOAD_VIDEO_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["name", "source"],
+                    "properties": {
+                        "name": {"type": "string"},
+                        "source": {"type": "string", "format": "binary", "description": "mp4 video"},
+                    },
+                },
+            },
+        },
+    },
+}
+
+# This route will add a video to the user (multipart form: name, source)
+# the body is only read once the token is verified, and streamed to the public directory
+@app.post("/user/{user_id}/video", status_code=201, openapi_extra=UPLOAD_VIDEO_OPENAPI)
+async def add_video_to_user_route(request: Request, user_id: int = Path(...), Authorization: str = Header(...)):
+    await verify_token_async(Authorization, user_id)
+    name, source = await receive_video_upload(request)
+    response = await add_video_to_user_async(user_id, name, source)
+    # renditions are produced in the background and recorded as video formats
+    enqueue_video(response["data"]["id"], response["data"]["source"])
+    return response
+
+# This route will get a list of videos (public, responses are cached until the listed videos change)
 @app.get("/videos", status_code=200)
-async def get_videos_route(name: str = '', user:str = '', duration: int = 0, page: int = 1, perPage: int = 5):
-    return get_videos(VideoList(name=name, user=user, duration=duration, page=page, perPage=perPage))
+async def get_videos_route(request: Request, name: str = '', user:str = '', duration: int = 0, page: int = 1, perPage: int = 5, after: str = None, withTotal: bool = False):
+    body = VideoList(name=name, user=user, duration=duration, page=page, perPage=perPage, after=after, withTotal=withTotal)
+    return await cached_video_list(request, body, lambda: get_videos_async(body))
+
+# This route will get many videos by id in one request (?ids=1,2,3)
+@app.get("/videos/batch", status_code=200)
+async def get_videos_batch_route(ids: str = ''):
+    return fast_json(await get_videos_by_ids_async(validate_ids(ids)))
 
 # This route will get a list of videos of the specified user
 @app.get("/user/{user_id}/videos", status_code=200)
 async def get_user_videos_route(user_id: int, body: BodyVideoListByUser, request: Request):
-    verify_token(request.headers.get("Authorization"))
-    return get_videos(VideoList(user=user_id, page=body.page, perPage=body.perPage))
+    await verify_token_async(request.headers.get("Authorization"))
+    return fast_json(await get_videos_async(VideoList(user=user_id, page=body.page, perPage=body.perPage, after=body.after, withTotal=body.withTotal)))
 
 # This route will update a video
 @app.put("/video/{video_id}", status_code=200)
 async def update_video_route(video_id: int, body: BodyVideoUpdate, request: Request):
-    verify_token(request.headers.get("Authorization"), body.user)
-    return update_video(video_id, body.name)
+    await verify_token_async(request.headers.get("Authorization"), body.user)
+    return await update_video_async(video_id, body.name)
 
 # This route will delete a video
 @app.delete("/video/{video_id}", status_code=204)
 async def delete_video_route(video_id: int, request: Request):
-    user_id = verify_token(request.headers.get("Authorization"))
-    return delete_video(video_id, user_id)
+    user_id = await verify_token_async(request.headers.get("Authorization"))
+    return await delete_video_async(video_id, user_id)
 
 # This route will add a comment to a video
 @app.post("/video/{video_id}/comment", status_code=201)
 async def add_comment_to_video_route(video_id: int, body: BodyAddComment, request: Request):
-    user_id = verify_token(request.headers.get("Authorization"))
-    return add_comment_to_video(video_id, user_id, body.body)
+    user_id = await verify_token_async(request.headers.get("Authorization"))
+    return await add_comment_to_video_async(video_id, user_id, body.body)
 
 # This route will get a list of comments of the specified video
 @app.get("/video/{video_id}/comments", status_code=200)
 async def get_comments_of_video_route(video_id: int, body: BodyListComments, request: Request):
-    verify_token(request.headers.get("Authorization"))
-    return get_comments_of_video(video_id, body.page, body.perPage)
+    await verify_token_async(request.headers.get("Authorization"))
+    return fast_json(await get_comments_of_video_async(video_id, body.page, body.perPage, body.after, body.withTotal))
 
 # This route adds a video format to the database
 @app.patch("/video/{video_id}", status_code=201)
 async def add_video_format_route(video_id: int, body: BodyAddFormat):
-    return add_video_format(video_id, body.format, body.file)
+    return await add_video_format_async(video_id, body.format, body.file)
+
+# This route streams the file of a video, supporting Range requests so players can seek
+@app.api_route("/video/{video_id}/stream", methods=["GET", "HEAD"])
+async def stream_video_route(video_id: int, request: Request):
+    path = await get_video_file_async(video_id)
+    response = RangeFileResponse(path, request)
+    if response.counts_as_view:
+        record_view(video_id)
+    return response
+
+# This route streams one of the formats (renditions) of a video
+@app.api_route("/video/{video_id}/stream/{format}", methods=["GET", "HEAD"])
+async def stream_video_format_route(video_id: int, format: str, request: Request):
+    path = await get_video_file_async(video_id, format)
+    response = RangeFileResponse(path, request)
+    if response.counts_as_view:
+        record_view(video_id)
+    return response
@@ -0,0 +1,245 @@
+import os
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# In-process metrics in the Prometheus text format, served by GET /metrics
+# every worker process keeps its own values: scrape each worker, or sum them on the Prometheus side
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# latency buckets (seconds)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics = []
+
+############################################################## METRIC TYPES ##############################################################
+
+class Metric:
+  labelnames = ()
+
+  # names of the labels of a sample, histograms add le to their buckets
+  def sample_labelnames(self, sample_name: str):
+    return self.labelnames
+
+# Monotonic counter, one value per combination of label values
+class Counter(Metric):
+  kind = "counter"
+
+  def __init__(self, name: str, help: str, labelnames=()):
+    self.name = name
+    self.help = help
+    self.labelnames = labelnames
+    self._values = {}
+    self._lock = Lock()
+    _metrics.append(self)
+
+  def inc(self, *labelvalues, amount: float = 1):
+    with self._lock:
+      self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+  def samples(self):
+    with self._lock:
+      return [(self.name, labels, value) for labels, value in self._values.items()]
+
+# Cumulative histogram: bucket counts, sum and count per combination of label values
+class Histogram(Metric):
+  kind = "histogram"
+
+  def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+    self.name = name
+    self.help = help
+    self.labelnames = labelnames
+    self.buckets = tuple(buckets)
+    self._values = {}
+    self._lock = Lock()
+    _metrics.append(self)
+
+  def observe(self, value: float, *labelvalues):
+    # le is inclusive: the value goes to the first bucket >= value, the last slot is +Inf
+    index = bisect_left(self.buckets, value)
+    with self._lock:
+      entry = self._values.get(labelvalues)
+      if entry is None:
+        entry = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+      entry[0][index] += 1
+      entry[1] += value
+      entry[2] += 1
+
+  def samples(self):
+    samples = []
+    with self._lock:
+      for labels, (counts, total, count) in self._values.items():
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+          cumulative += bucket_count
+          samples.append((self.name + "_bucket", labels + (_format_value(bound),), cumulative))
+        samples.append((self.name + "_sum", labels, total))
+        samples.append((self.name + "_count", labels, count))
+    return samples
+
+  def sample_labelnames(self, sample_name: str):
+    return self.labelnames + ("le",) if sample_name.endswith("_bucket") else self.labelnames
+
+# Value read when the metrics are rendered: collect() returns {labelvalues: value}
+class CallbackGauge(Metric):
+  kind = "gauge"
+
+  def __init__(self, name: str, help: str, labelnames, collect):
+    self.name = name
+    self.help = help
+    self.labelnames = labelnames
+    self.collect = collect
+    _metrics.append(self)
+
+  def samples(self):
+    try:
+      return [(self.name, labels, value) for labels, value in self.collect().items()]
+    except Exception as e:
+      print("Error while collecting metric {}:".format(self.name))
+      print(e)
+      return []
+
+############################################################## EXPOSITION ##############################################################
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Renders every metric in the Prometheus text exposition format
+def render() -> str:
+  lines = []
+  for metric in _metrics:
+    lines.append("# HELP {} {}".format(metric.name, metric.help))
+    lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+    for sample_name, labelvalues, value in metric.samples():
+      lines.append("{}{} {}".format(sample_name, _format_labels(metric.sample_labelnames(sample_name), labelvalues), _format_value(value)))
+  return "\n".join(lines) + "\n"
+
+def _format_labels(labelnames, labelvalues) -> str:
+  if not labelnames:
+    return ""
+  pairs = []
+  for name, value in zip(labelnames, labelvalues):
+    escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    pairs.append('{}="{}"'.format(name, escaped))
+  return "{" + ",".join(pairs) + "}"
+
+def _format_value(value) -> str:
+  if value == float("inf"):
+    return "+Inf"
+  if isinstance(value, float) and value.is_integer():
+    return str(int(value)) if abs(value) < 1e15 else repr(value)
+  return str(value)
+
+############################################################## APPLICATION METRICS ##############################################################
+
+HTTP_REQUESTS = Counter("http_requests_total", "Requests served, by route template, method and status", ("route", "method", "status"))
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time to serve a request, by route template and method", ("route", "method"))
+
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "Time of a single statement, by operation", ("operation",))
+DB_QUERIES_PER_REQUEST = Histogram("db_queries_per_request", "Statements executed while serving a request, by route template", ("route",), buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+DB_SECONDS_PER_REQUEST = Histogram("db_duration_per_request_seconds", "Time spent in the db while serving a request, by route template", ("route",))
+DB_POOL_CHECKOUT_SECONDS = Histogram("db_pool_checkout_wait_seconds", "Time waited for a connection of the pool, by engine", ("engine",), buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30))
+
+UPLOADS = Counter("video_uploads_total", "Video uploads saved to the public directory")
+UPLOAD_BYTES = Counter("video_upload_bytes_total", "Bytes of the saved video uploads")
+UPLOAD_SECONDS = Histogram("video_upload_duration_seconds", "Time to stream an upload to disk", buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+TRANSCODE_JOBS = Counter("transcode_jobs_total", "Transcoding jobs run, by kind (probe, rendition) and result", ("kind", "result"))
+TRANSCODE_SECONDS = Histogram("transcode_duration_seconds", "Time to produce a rendition, by rendition", ("rendition",), buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+TRANSCODE_BYTES = Counter("transcode_output_bytes_total", "Bytes of the produced renditions")
+TOKENS_SWEPT = Counter("tokens_swept_total", "Expired tokens deleted by the token sweeper")
+
+_caches = {}
+_gauges = {}
+_pools = {}
+
+def _cache_stats(key: str):
+  return {(name,): cache.stats().get(key, 0) for name, cache in _caches.items()}
+
+CallbackGauge("cache_hits", "Hits of the in-process caches since start", ("cache",), lambda: _cache_stats("hits"))
+CallbackGauge("cache_misses", "Misses of the in-process caches since start", ("cache",), lambda: _cache_stats("misses"))
+CallbackGauge("cache_hit_ratio", "Hits / lookups of the in-process caches since start", ("cache",), lambda: _cache_stats("hit_ratio"))
+CallbackGauge("background_queue_size", "Pending work of the background components, by component", ("component",), lambda: {(name,): size() for name, size in _gauges.items()})
+CallbackGauge("db_pool_checked_out", "Connections of the pool currently in use, by engine", ("engine",), lambda: {(name,): pool.checkedout() for name, pool in _pools.items()})
+
+# Exposes the hit/miss counters of a cache (anything with a stats() dict: TTLCache, response cache backends)
+def register_cache(name: str, cache):
+  if cache is not None:
+    _caches[name] = cache
+
+# Exposes the size of a background queue, size() is called on every scrape
+def register_queue(name: str, size):
+  _gauges[name] = size
+
+# Exposes the connections in use of a pool
+def register_pool(name: str, pool):
+  _pools[name] = pool
+
+############################################################## REQUEST HOOKS ##############################################################
+
+# Statements and db time of the request being served, shared with the threadpool and the session greenlet
+_request_stats = ContextVar("request_stats", default=None)
+
+# ASGI middleware timing every http request, the route label is the path template (/video/{video_id}) so ids do not
+# create new series. The db statements of the request are counted by the cursor listeners below
+class MetricsMiddleware:
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http":
+      await self.app(scope, receive, send)
+      return
+
+    stats = {"queries": 0, "seconds": 0.0}
+    token = _request_stats.set(stats)
+    status = [500]
+
+    async def send_wrapper(message):
+      if message["type"] == "http.response.start":
+        status[0] = message["status"]
+      await send(message)
+
+    started = perf_counter()
+    try:
+      await self.app(scope, receive, send_wrapper)
+    except Exception as e:
+      # ApiException is turned into a response by the outermost error middleware
+      status[0] = getattr(e, "status_code", 500)
+      raise
+    finally:
+      elapsed = perf_counter() - started
+      _request_stats.reset(token)
+      route = scope.get("route")
+      route = route.path if route is not None else "<unmatched>"
+      HTTP_REQUESTS.inc(route, scope["method"], str(status[0]))
+      HTTP_REQUEST_SECONDS.observe(elapsed, route, scope["method"])
+      DB_QUERIES_PER_REQUEST.observe(stats["queries"], route)
+      DB_SECONDS_PER_REQUEST.observe(stats["seconds"], route)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault("query_started", []).append(perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  started = conn.info.get("query_started")
+  if not started:
+    return
+  elapsed = perf_counter() - started.pop()
+  DB_QUERY_SECONDS.observe(elapsed, statement.lstrip().split(" ", 1)[0].lower())
+  stats = _request_stats.get()
+  if stats is not None:
+    stats["queries"] += 1
+    stats["seconds"] += elapsed
+
+# a statement that fails never reaches after_cursor_execute
+def _handle_error(exception_context):
+  started = exception_context.connection.info.get("query_started") if exception_context.connection is not None else None
+  if started:
+    started.pop()
+
+# listeners on the Engine class: they apply to every engine, the async engines included (they run the sync engine)
+if METRICS_ENABLED:
+  event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+  event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+  event.listen(Engine, "handle_error", _handle_error)
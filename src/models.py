@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Union
+from typing import Optional, Union
 
 # This is the User model that will be used to validate the request body
 class User(BaseModel):
@@ -18,6 +18,8 @@ class GetUsersItem(BaseModel):
   pseudo: str = ''
   page: int = 1 # default value
   perPage: int  = 5 # default value
+  after: Optional[str] = None # cursor of the next page, replaces page
+  withTotal: bool = False # count the total when paginating by cursor
 
 # custom exception
 class ApiException(Exception):
@@ -27,6 +29,7 @@ class ApiException(Exception):
       401: "Unauthorized",
       403: "Forbidden",
       404: "Not Found",
+      413: "Payload Too Large",
       500: "Internal Server Error"
     }
     self.message = switcher.get(status_code, "Internal Server Error")
@@ -41,10 +44,14 @@ class VideoList(BaseModel):
   duration: int = None
   page: int = 1
   perPage: int = 5
+  after: Optional[str] = None
+  withTotal: bool = False
 
 class BodyVideoListByUser(BaseModel):
   page: int = 1
   perPage: int = 5
+  after: Optional[str] = None
+  withTotal: bool = False
 
 class BodyVideoUpdate(BaseModel):
   name: str = None
@@ -56,6 +63,8 @@ class BodyAddComment(BaseModel):
 class BodyListComments(BaseModel):
   page: int = 1
   perPage: int = 5
+  after: Optional[str] = None
+  withTotal: bool = False
 
 class BodyAddFormat(BaseModel):
   format: str = None
@@ -0,0 +1,56 @@
+import base64
+import json
+import os
+from src.cache import TTLCache
+from src.metrics import register_cache
+
+INVALID_CURSOR_MSG = "Invalid cursor"
+
+# totals of the paginated listings are counted at most once every PAGER_COUNT_CACHE_TTL seconds per filter
+PAGER_COUNT_CACHE_TTL = int(os.getenv("PAGER_COUNT_CACHE_TTL", 5))
+count_cache = TTLCache(int(os.getenv("PAGER_COUNT_CACHE_SIZE", 1024)), PAGER_COUNT_CACHE_TTL)
+register_cache("pager_counts", count_cache)
+
+# Opaque cursor pointing after the row with the given id
+def encode_cursor(last_id: int) -> str:
+  return base64.urlsafe_b64encode(json.dumps({"id": last_id}).encode("utf-8")).decode("utf-8").rstrip("=")
+
+# Returns the id a cursor points after, raises ValueError(INVALID_CURSOR_MSG) for a malformed cursor
+def decode_cursor(cursor: str) -> int:
+  try:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    return int(json.loads(base64.urlsafe_b64decode(padded.encode("utf-8")))["id"])
+  except Exception:
+    raise ValueError(INVALID_CURSOR_MSG)
+
+# Fetches one page of statement ordered by id_column (newest first when descending)
+# after (a cursor) uses the primary key index (keyset pagination), otherwise page is used as an offset
+# Returns the rows of the page and the cursor of the next page (None on the last page)
+# ranked pages (statement already ordered by relevance) get no cursor: an id cursor would skip or repeat rows
+def fetch_page(session, statement, id_column, per_page: int, page: int = 1, after: str = None, descending: bool = False, ranked: bool = False):
+  rows = session.scalars(page_statement(statement, id_column, per_page, page, after, descending)).all()
+  next_cursor = encode_cursor(rows[per_page - 1].id) if len(rows) > per_page and not ranked else None
+  return rows[:per_page], next_cursor
+
+# Returns statement restricted to one page, with one extra row telling if there is a next page
+def page_statement(statement, id_column, per_page: int, page: int = 1, after: str = None, descending: bool = False):
+  if after is not None:
+    after_id = decode_cursor(after)
+    statement = statement.where(id_column < after_id if descending else id_column > after_id)
+  else:
+    statement = statement.offset(max(page - 1, 0) * per_page)
+  return statement.order_by(id_column.desc() if descending else id_column).limit(per_page + 1)
+
+# Runs a count statement, cached per statement and parameters
+def cached_count(session, statement) -> int:
+  key = count_key(statement, session.get_bind().dialect)
+  total = count_cache.get(key)
+  if total is None:
+    total = session.scalars(statement).first()
+    count_cache.set(key, total)
+  return total
+
+# Cache key of a count statement, compiled for the dialect of the db (the default one can not render MATCH ... AGAINST)
+def count_key(statement, dialect):
+  compiled = statement.compile(dialect=dialect)
+  return (str(compiled), tuple(sorted((k, repr(v)) for k, v in compiled.params.items())))
@@ -0,0 +1,120 @@
+import heapq
+import hmac
+import json
+import logging
+import os
+from contextvars import ContextVar
+from time import perf_counter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Opt-in SQL profiling of the requests
+# "off": disabled, "header": requests sending X-SQL-Profile: 1, "all": every request
+SQL_PROFILING = os.getenv("SQL_PROFILING", "off").lower()
+# statement excerpts are only sent to requests carrying X-SQL-Profile: <SQL_PROFILE_SECRET> (they disclose
+# the schema), other profiled requests get the timings and statement counts only
+SQL_PROFILE_SECRET = os.getenv("SQL_PROFILE_SECRET", "")
+# slowest statements reported per request
+SQL_PROFILE_TOP = int(os.getenv("SQL_PROFILE_TOP", 3))
+# statements slower than this (ms) are written to the slow query log, 0 disables it
+SQL_SLOW_QUERY_MS = float(os.getenv("SQL_SLOW_QUERY_MS", 0))
+
+PROFILE_REQUEST_HEADER = b"x-sql-profile"
+
+# one json object per line: {"event": "slow_query", "duration_ms": ..., "statement": ..., "method": ..., "path": ...}
+slow_query_logger = logging.getLogger("sql.slow")
+
+# Profile of the request being served, shared with the threadpool and the session greenlet
+_profile = ContextVar("sql_profile", default=None)
+
+def profiling_enabled() -> bool:
+  return SQL_PROFILING in ("header", "all") or SQL_SLOW_QUERY_MS > 0
+
+# ASGI middleware collecting the statements of the request: count, db time and the slowest ones are sent
+# in a Server-Timing header when the request is profiled, statements over SQL_SLOW_QUERY_MS are logged
+class ProfilingMiddleware:
+  def __init__(self, app):
+    self.app = app
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http":
+      await self.app(scope, receive, send)
+      return
+
+    opt_in = dict(scope["headers"]).get(PROFILE_REQUEST_HEADER)
+    trusted = bool(SQL_PROFILE_SECRET) and opt_in is not None and hmac.compare_digest(opt_in, SQL_PROFILE_SECRET.encode("utf-8"))
+    profiled = SQL_PROFILING == "all" or (SQL_PROFILING == "header" and (opt_in == b"1" or trusted))
+    if not profiled and SQL_SLOW_QUERY_MS <= 0:
+      await self.app(scope, receive, send)
+      return
+
+    profile = {"statements": 0, "seconds": 0.0, "slowest": [], "method": scope["method"], "path": scope["path"]}
+    token = _profile.set(profile)
+    started = perf_counter()
+
+    async def send_wrapper(message):
+      if profiled and message["type"] == "http.response.start":
+        message["headers"] = list(message.get("headers", [])) + [(b"server-timing", server_timing(profile, perf_counter() - started, trusted).encode("latin-1"))]
+      await send(message)
+
+    try:
+      await self.app(scope, receive, send_wrapper if profiled else send)
+    finally:
+      _profile.reset(token)
+
+# Server-Timing value of a profile: db time and statement count, then the slowest statements
+# e.g. db;dur=12.4;desc="7 statements", sql-1;dur=8.1;desc="SELECT video.id ...", app;dur=20.3
+# (without with_statements: sql-1;dur=8.1)
+def server_timing(profile: dict, elapsed: float, with_statements: bool = False) -> str:
+  metrics = ['db;dur={:.2f};desc="{} statements"'.format(profile["seconds"] * 1000, profile["statements"])]
+  for rank, (seconds, statement) in enumerate(sorted(profile["slowest"], reverse=True), start=1):
+    metric = "sql-{};dur={:.2f}".format(rank, seconds * 1000)
+    metrics.append(metric + ';desc="{}"'.format(_describe(statement)) if with_statements else metric)
+  metrics.append("app;dur={:.2f}".format(elapsed * 1000))
+  return ", ".join(metrics)
+
+# single line, header safe excerpt of a statement
+def _describe(statement: str, length: int = 80) -> str:
+  text = " ".join(statement.split())
+  text = text if len(text) <= length else text[:length - 3] + "..."
+  return text.replace("\\", "").replace('"', "'").encode("latin-1", "replace").decode("latin-1")
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  if _profile.get() is not None:
+    conn.info.setdefault("profile_started", []).append(perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  profile = _profile.get()
+  started = conn.info.get("profile_started")
+  if profile is None or not started:
+    return
+  elapsed = perf_counter() - started.pop()
+  profile["statements"] += 1
+  profile["seconds"] += elapsed
+  # min-heap of the slowest statements
+  if len(profile["slowest"]) < SQL_PROFILE_TOP:
+    heapq.heappush(profile["slowest"], (elapsed, statement))
+  elif SQL_PROFILE_TOP > 0 and elapsed > profile["slowest"][0][0]:
+    heapq.heapreplace(profile["slowest"], (elapsed, statement))
+
+  if SQL_SLOW_QUERY_MS > 0 and elapsed * 1000 >= SQL_SLOW_QUERY_MS:
+    slow_query_logger.warning(json.dumps({
+      "event": "slow_query",
+      "duration_ms": round(elapsed * 1000, 2),
+      "statement": " ".join(statement.split()),
+      "executemany": executemany,
+      "method": profile["method"],
+      "path": profile["path"],
+    }))
+
+# a statement that fails never reaches after_cursor_execute
+def _handle_error(exception_context):
+  started = exception_context.connection.info.get("profile_started") if exception_context.connection is not None else None
+  if started and _profile.get() is not None:
+    started.pop()
+
+# listeners on the Engine class: they apply to every engine, the async engines included (they run the sync engine)
+if profiling_enabled():
+  event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+  event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+  event.listen(Engine, "handle_error", _handle_error)
@@ -0,0 +1,234 @@
+import hashlib
+import json
+import os
+import time
+from threading import Lock
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.util.concurrency import await_only, in_greenlet
+from starlette.responses import Response
+from src.cache import TTLCache
+from src.metrics import register_cache
+from src.models import VideoList
+from src.responses import dump_json
+from src.db.connection import db_replica_urls, read_your_writes_window, read_from_primary
+
+# Cache of the serialized responses of the public video listing (GET /videos)
+# Entries are tagged with the rows they contain and the listings they belong to,
+# the video controllers invalidate the tags of the rows they write
+VIDEO_LIST_CACHE_ENABLED = os.getenv("VIDEO_LIST_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+# shared backend (e.g. redis://cache:6379/0), the in-process cache is used when empty
+VIDEO_LIST_CACHE_URL = os.getenv("VIDEO_LIST_CACHE_URL", "")
+# the in-process cache is per worker: an invalidation only reaches the worker serving the write and the other
+# workers of src.server serve their stale entries until they expire, so the default ttl is a few seconds
+# when several workers share the in-process backend (an unset or unresolved WEB_WORKERS means one)
+_shared_backend = VIDEO_LIST_CACHE_URL.startswith("redis") or max(int(os.getenv("WEB_WORKERS") or 1), 1) == 1
+VIDEO_LIST_CACHE_TTL = int(os.getenv("VIDEO_LIST_CACHE_TTL", 60 if _shared_backend else 5))
+VIDEO_LIST_CACHE_SIZE = int(os.getenv("VIDEO_LIST_CACHE_SIZE", 2048))
+# max-age sent to clients and CDNs, they revalidate with If-None-Match afterwards
+VIDEO_LIST_MAX_AGE = int(os.getenv("VIDEO_LIST_MAX_AGE", 0))
+
+############################################################## BACKENDS ##############################################################
+
+# In-process backend: a TTLCache plus an index of the keys of every tag
+# entries leave the TTLCache on their own (eviction, expiry): the index is pruned of them as it grows
+class MemoryBackend:
+  blocking = False
+
+  def __init__(self, maxsize: int, ttl: int):
+    self.entries = TTLCache(maxsize, ttl)
+    # tag -> keys, and key -> tags to unlink a key from all of them
+    self._tags = {}
+    self._key_tags = {}
+    self._generation = 0
+    self._invalidated_at = 0.0
+    self._lock = Lock()
+
+  def get(self, key: str):
+    return self.entries.get(key)
+
+  # stores value unless an invalidation happened since generation was read
+  def set(self, key: str, value, tags, generation: int):
+    with self._lock:
+      if generation != self._generation:
+        return
+      self._forget(key)
+      self.entries.set(key, value)
+      self._key_tags[key] = tags
+      for tag in tags:
+        self._tags.setdefault(tag, set()).add(key)
+      # at most once every maxsize sets, so the scan stays cheap
+      if len(self._key_tags) > 2 * self.entries.maxsize:
+        self._prune()
+
+  def invalidate(self, tags):
+    with self._lock:
+      self._generation += 1
+      self._invalidated_at = time.time()
+      for tag in tags:
+        for key in list(self._tags.get(tag, ())):
+          self._forget(key)
+          self.entries.delete(key)
+
+  # unlinks key from its tags, the lock is held by the caller
+  def _forget(self, key: str):
+    for tag in self._key_tags.pop(key, ()):
+      keys = self._tags.get(tag)
+      if keys is not None:
+        keys.discard(key)
+        if not keys:
+          del self._tags[tag]
+
+  # drops the keys evicted or expired from entries
+  def _prune(self):
+    for key in [key for key in self._key_tags if key not in self.entries]:
+      self._forget(key)
+
+  def generation(self) -> int:
+    return self._generation
+
+  # time of the last invalidation (epoch seconds)
+  def invalidated_at(self) -> float:
+    return self._invalidated_at
+
+  def stats(self):
+    return self.entries.stats()
+
+# Shared backend on redis, so every worker sees the same entries and invalidations
+# needs the redis package (pip install redis), which is not a dependency of the api
+# the client blocks: the calls made from the event loop go through the threadpool (see _cache_call)
+class RedisBackend:
+  blocking = True
+
+  def __init__(self, url: str, ttl: int, prefix: str = "videos-cache:"):
+    import redis
+    self.client = redis.Redis.from_url(url)
+    self.ttl = ttl
+    self.prefix = prefix
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key: str):
+    value = self.client.get(self.prefix + key)
+    if value is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return json.loads(value)
+
+  def set(self, key: str, value, tags, generation: int):
+    if generation != self.generation():
+      return
+    pipe = self.client.pipeline()
+    pipe.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+    for tag in tags:
+      pipe.sadd(self.prefix + "tag:" + tag, key)
+      pipe.expire(self.prefix + "tag:" + tag, self.ttl)
+    pipe.execute()
+
+  def invalidate(self, tags):
+    self.client.incr(self.prefix + "generation")
+    self.client.set(self.prefix + "invalidated_at", time.time())
+    for tag in tags:
+      tag_key = self.prefix + "tag:" + tag
+      keys = self.client.smembers(tag_key)
+      if keys:
+        self.client.delete(*[self.prefix + key.decode("utf-8") for key in keys])
+      self.client.delete(tag_key)
+
+  def generation(self) -> int:
+    return int(self.client.get(self.prefix + "generation") or 0)
+
+  def invalidated_at(self) -> float:
+    return float(self.client.get(self.prefix + "invalidated_at") or 0)
+
+  def stats(self):
+    total = self.hits + self.misses
+    return {"hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / total if total else 0.0}
+
+def create_backend():
+  if VIDEO_LIST_CACHE_URL.startswith("redis"):
+    return RedisBackend(VIDEO_LIST_CACHE_URL, VIDEO_LIST_CACHE_TTL)
+  return MemoryBackend(VIDEO_LIST_CACHE_SIZE, VIDEO_LIST_CACHE_TTL)
+
+video_list_cache = create_backend() if VIDEO_LIST_CACHE_ENABLED else None
+register_cache("video_lists", video_list_cache)
+
+############################################################## KEYS AND TAGS ##############################################################
+
+# Normalized parameters of a listing: filters that select every video are dropped
+def video_list_key(body: VideoList) -> str:
+  return "videos:" + json.dumps([
+    body.name or None,
+    str(body.user) if body.user not in (None, "") else None,
+    body.duration if body.duration and body.duration > 0 else None,
+    body.page,
+    body.perPage,
+    body.after,
+    body.withTotal,
+  ])
+
+# a listing depends on the rows it shows and on the set of videos matching its filters
+def video_list_tags(body: VideoList, content: dict):
+  user = str(body.user) if body.user not in (None, "") else "*"
+  tags = ["list:user:{}".format(user)]
+  if body.name:
+    tags.append("search:user:{}".format(user))
+  tags += ["video:{}".format(video["id"]) for video in content.get("data", [])]
+  return tags
+
+# Invalidates the listings affected by a write on a video
+# membership: the video was added or removed, every listing it matches changes (pages, totals)
+# renamed: the name changed, name searches may now include or exclude it
+def invalidate_video(video_id: int, user_id: int, username: str = None, membership: bool = False, renamed: bool = False):
+  if video_list_cache is None:
+    return
+  owners = ["*", str(user_id)] + ([username] if username else [])
+  tags = ["video:{}".format(video_id)]
+  if membership:
+    tags += ["list:user:{}".format(owner) for owner in owners]
+  if renamed:
+    tags += ["search:user:{}".format(owner) for owner in owners]
+  try:
+    if video_list_cache.blocking and in_greenlet():
+      # a controller run by AsyncSession.run_sync, on the event loop thread: the call is awaited in the threadpool
+      await_only(run_in_threadpool(video_list_cache.invalidate, tags))
+    else:
+      video_list_cache.invalidate(tags)
+  except Exception as e:
+    print("Error while invalidating video listings cache:")
+    print(e)
+
+############################################################## RESPONSES ##############################################################
+
+# Calls a method of the backend from the event loop, in the threadpool when the backend blocks
+async def _cache_call(method, *args):
+  if video_list_cache.blocking:
+    return await run_in_threadpool(method, *args)
+  return method(*args)
+
+# Returns the cached listing for body, producing it with await producer() on a miss
+# The response carries an ETag and Cache-Control, a matching If-None-Match gets a 304
+async def cached_video_list(request: Request, body: VideoList, producer) -> Response:
+  key = video_list_key(body)
+  entry = await _cache_call(video_list_cache.get, key) if video_list_cache is not None else None
+  if entry is None:
+    generation = await _cache_call(video_list_cache.generation) if video_list_cache is not None else 0
+    # the replicas may not have the write behind a recent invalidation yet: the entry
+    # would keep their stale rows for the whole ttl, so it is filled from the primary
+    if video_list_cache is not None and db_replica_urls and time.time() - await _cache_call(video_list_cache.invalidated_at) < read_your_writes_window:
+      read_from_primary()
+    content = await producer()
+    payload = dump_json(content)
+    entry = {"body": payload.decode("utf-8"), "etag": '"{}"'.format(hashlib.sha1(payload).hexdigest())}
+    if video_list_cache is not None:
+      await _cache_call(video_list_cache.set, key, entry, video_list_tags(body, content), generation)
+
+  headers = {
+    "etag": entry["etag"],
+    "cache-control": "public, max-age={}".format(VIDEO_LIST_MAX_AGE),
+  }
+  if_none_match = request.headers.get("if-none-match")
+  if if_none_match is not None and entry["etag"] in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+    return Response(status_code=304, headers=headers)
+  return Response(content=entry["body"], media_type="application/json", headers=headers)
@@ -0,0 +1,140 @@
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+import anyio
+import orjson
+from fastapi import Request
+from fastapi.responses import ORJSONResponse
+from starlette.responses import Response
+
+RANGE_REGEX = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# Response of the hot list routes: the content is dumped by orjson as is, without the
+# jsonable_encoder pass of FastAPI, so it must only hold json native types and datetimes (see src/serializers.py)
+def fast_json(content, status_code: int = 200) -> Response:
+  return ORJSONResponse(content, status_code=status_code)
+
+# Dumps content like fast_json does
+def dump_json(content) -> bytes:
+  return orjson.dumps(content)
+
+# Serves a file with single Range requests, ETag/If-None-Match and Last-Modified support
+# The body is sent with the zero-copy sendfile extension when the ASGI server provides it,
+# otherwise it is read in chunks off the event loop
+class RangeFileResponse(Response):
+  chunk_size = 256 * 1024
+
+  def __init__(self, path: str, request: Request, media_type: str = "video/mp4", max_age: int = 3600):
+    stat = os.stat(path)
+    self.path = path
+    self.media_type = media_type
+    self.background = None
+    self.send_body = request.method != "HEAD"
+    size = stat.st_size
+    etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, size)
+    headers = {
+      "accept-ranges": "bytes",
+      "etag": etag,
+      "last-modified": formatdate(stat.st_mtime, usegmt=True),
+      "cache-control": "public, max-age={}".format(max_age),
+    }
+
+    self.start, self.end = 0, size - 1
+    self.counts_as_view = False
+    if is_not_modified(request, etag, stat.st_mtime):
+      self.status_code = 304
+      self.send_body = False
+    else:
+      byte_range = request.headers.get("range")
+      # If-Range: the range only applies while the client copy is still current
+      if byte_range and is_single_range(byte_range) and request.headers.get("if-range", etag) == etag:
+        parsed = parse_range(byte_range, size)
+        if parsed is None:
+          self.status_code = 416
+          self.send_body = False
+          headers["content-range"] = "bytes */{}".format(size)
+          headers["content-length"] = "0"
+          self.init_headers(headers)
+          return
+        self.start, self.end = parsed
+        self.status_code = 206
+        headers["content-range"] = "bytes {}-{}/{}".format(self.start, self.end, size)
+      else:
+        self.status_code = 200
+      headers["content-length"] = str(self.end - self.start + 1)
+    # a play is the first request of the file, the following ranges are seeks
+    self.counts_as_view = self.send_body and self.start == 0
+    self.init_headers(headers)
+
+  async def __call__(self, scope, receive, send):
+    await send({
+      "type": "http.response.start",
+      "status": self.status_code,
+      "headers": self.raw_headers,
+    })
+    count = self.end - self.start + 1
+    if not self.send_body or count <= 0:
+      await send({"type": "http.response.body", "body": b"", "more_body": False})
+      return
+
+    if "http.response.zerocopysend" in scope.get("extensions", {}):
+      with open(self.path, "rb") as file:
+        await send({
+          "type": "http.response.zerocopysend",
+          "file": file.fileno(),
+          "offset": self.start,
+          "count": count,
+          "more_body": False,
+        })
+      return
+
+    async with await anyio.open_file(self.path, mode="rb") as file:
+      await file.seek(self.start)
+      while count > 0:
+        chunk = await file.read(min(self.chunk_size, count))
+        if not chunk:
+          break
+        count -= len(chunk)
+        await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+    if count > 0:
+      # the file shrank while being sent
+      await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+# Tells if byte_range is a single byte range, the only kind served: other Range headers (several ranges,
+# other units, malformed) are ignored and the whole file is sent with a 200
+def is_single_range(byte_range: str) -> bool:
+  match = RANGE_REGEX.match(byte_range.strip())
+  return match is not None and (match.group(1) != "" or match.group(2) != "")
+
+# Returns (start, end) of a single byte range, None when it can not be satisfied
+def parse_range(byte_range: str, size: int):
+  match = RANGE_REGEX.match(byte_range.strip())
+  if match is None or size == 0:
+    return None
+  start, end = match.group(1), match.group(2)
+  if start == "" and end == "":
+    return None
+  if start == "":
+    # suffix range: last n bytes, bytes=-0 selects nothing and is not satisfiable
+    if int(end) == 0:
+      return None
+    return max(size - int(end), 0), size - 1
+  start = int(start)
+  end = size - 1 if end == "" else min(int(end), size - 1)
+  if start > end:
+    return None
+  return start, end
+
+# If-None-Match has precedence over If-Modified-Since
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+  if_none_match = request.headers.get("if-none-match")
+  if if_none_match is not None:
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags or "*" in tags
+  if_modified_since = request.headers.get("if-modified-since")
+  if if_modified_since is not None:
+    try:
+      return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+      return False
+  return False
@@ -0,0 +1,27 @@
+import os
+import re
+from sqlalchemy.dialects.mysql import match
+from src.db.connection import db_url
+
+# "fulltext" searches names with the FULLTEXT indexes (MariaDB only), "like" with LIKE '%term%'
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "fulltext")
+# words shorter than this are not indexed (innodb_ft_min_token_size), such searches use LIKE
+FULLTEXT_MIN_WORD_LENGTH = int(os.getenv("FULLTEXT_MIN_WORD_LENGTH", 3))
+
+# characters with a meaning in boolean mode full-text queries
+BOOLEAN_OPERATORS_REGEX = re.compile(r'[+\-<>()~*"@]+')
+
+def fulltext_enabled() -> bool:
+  return SEARCH_BACKEND == "fulltext" and db_url.startswith("mysql")
+
+# Returns the where clause matching column against the search string
+# and the relevance expression to order by (None when searching with LIKE)
+def search_filter(column, search: str):
+  words = BOOLEAN_OPERATORS_REGEX.sub(" ", search).split() if fulltext_enabled() else []
+  if not words or min(len(word) for word in words) < FULLTEXT_MIN_WORD_LENGTH:
+    return column.like("%{}%".format(search)), None
+
+  # every word is required, as a prefix to stay close to the LIKE behaviour
+  query = " ".join("+{}*".format(word) for word in words)
+  relevance = match(column, against=query).in_boolean_mode()
+  return relevance, relevance
@@ -0,0 +1,43 @@
+import asyncio
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import jwt
+from bcrypt import hashpw, checkpw, gensalt
+
+# bcrypt cost factor of new hashes, existing hashes keep the cost they were created with
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+# bcrypt releases the GIL: a small dedicated pool hashes in parallel without starving the default threadpool
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", 0)) or min(4, os.cpu_count() or 1)
+
+_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+
+# Returns the bcrypt hash of password
+def hash_password(password: str) -> str:
+  return hashpw(password.encode("utf-8"), gensalt(rounds=BCRYPT_ROUNDS)).decode("utf-8")
+
+# Checks password against a bcrypt hash
+def check_password(password: str, password_hash: str) -> bool:
+  return checkpw(password.encode("utf-8"), password_hash.encode("utf-8"))
+
+# Same as hash_password, run in the bcrypt pool
+async def hash_password_async(password: str) -> str:
+  return await asyncio.get_running_loop().run_in_executor(_executor, hash_password, password)
+
+# Same as check_password, run in the bcrypt pool
+async def check_password_async(password: str, password_hash: str) -> bool:
+  return await asyncio.get_running_loop().run_in_executor(_executor, check_password, password, password_hash)
+
+# Signed JWT of a user, stored in token.code: VARCHAR(512) since migration-004, the claims must stay within it
+# (about 420 characters with 45 character ascii username, pseudo and email)
+def encode_token(user_id: int, username: str, pseudo: str, email: str, expires: datetime, secret: str = None) -> str:
+  return jwt.encode({
+    "user_id": user_id,
+    "username": username,
+    "pseudo": pseudo,
+    "email": email,
+    "exp": expires,
+    # two logins within the same second must not produce the same code
+    "jti": uuid.uuid4().hex,
+  }, secret or os.environ["SECRET_KEY"], algorithm="HS256")
@@ -0,0 +1,49 @@
+from src.views import pending_views
+
+# Shapes the rows of the db into the dicts sent by the api
+# Only json native types and datetimes are produced, so they can go straight to orjson
+
+# This function will convert a User object to a JSON object
+def user_to_json(user):
+  return None if user is None else {
+    "id": user.id,
+    "username": user.username,
+    "email": user.email,
+    "pseudo": user.pseudo,
+    "created_at": user.created_at,
+  }
+
+# Public fields of a user, shown to other users (no email)
+def public_user_to_json(user):
+  return None if user is None else {
+    "id": user.id,
+    "username": user.username,
+    "pseudo": user.pseudo,
+    "created_at": user.created_at,
+  }
+
+def video_to_json(video, user, video_format=None):
+  return {} if video is None else {
+    "id": video.id,
+    "name": video.name,
+    "source": video.source,
+    "created_at": video.created_at,
+    "views": video.views + pending_views(video.id),
+    "enabled": video.enabled,
+    "user": public_user_to_json(user),
+    "format": format_to_json(video_format)
+  }
+
+def format_to_json(video_format):
+  return {} if video_format is None else {f.code: f.uri for f in video_format}
+
+def comment_to_json(comment):
+  return {
+    "id": comment.id,
+    "body": comment.body,
+    "user": {
+      "id": comment.user.id,
+      "username": comment.user.username,
+      "pseudo": comment.user.pseudo,
+    }
+  }
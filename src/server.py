@@ -0,0 +1,145 @@
+import asyncio
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+import uvicorn
+
+# Production entry point: a prefork server running one uvicorn worker per process on a shared socket
+# usage: python -m src.server
+#
+# - WEB_PRELOAD imports the app (schema reflection included) once in the master before forking,
+#   the workers start right away and share the loaded modules copy-on-write. The db engines of the
+#   master are closed before forking and recreated in every worker (see reset_engines_after_fork)
+# - SIGTERM/SIGINT stop the workers gracefully: they stop accepting connections, in-flight requests
+#   (uploads included) get WEB_GRACEFUL_TIMEOUT seconds to complete, then the lifespan shutdown flushes
+#   the buffered views and the transcoding queue. Workers still running afterwards are killed
+# - workers exiting on their own (crash, WEB_MAX_REQUESTS) are replaced
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", 8000))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 0)) or os.cpu_count() or 1
+# the app sizes its per-process caches and pools on the actual worker count
+os.environ["WEB_WORKERS"] = str(WEB_WORKERS)
+WEB_PRELOAD = os.getenv("WEB_PRELOAD", "true").lower() in ("1", "true", "yes")
+WEB_GRACEFUL_TIMEOUT = int(os.getenv("WEB_GRACEFUL_TIMEOUT", 30))
+WEB_KEEP_ALIVE = int(os.getenv("WEB_KEEP_ALIVE", 5))
+# requests served by a worker before it is replaced, 0 for never
+WEB_MAX_REQUESTS = int(os.getenv("WEB_MAX_REQUESTS", 0))
+WEB_LOG_LEVEL = os.getenv("WEB_LOG_LEVEL", "info")
+
+APP = "src.main:app"
+# a worker dying sooner than this after its start is replaced after a pause, not in a tight loop
+MIN_WORKER_UPTIME = 1
+
+def bind_socket(host: str, port: int):
+  sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  sock.bind((host, port))
+  sock.listen(2048)
+  sock.set_inheritable(True)
+  return sock
+
+# Loads the app in the master, then closes the connections opened while reflecting the schema
+def preload_app():
+  from src.main import app
+  from src.db.connection import dispose_engines
+  asyncio.run(dispose_engines())
+  return app
+
+# Serves app on sock until SIGTERM/SIGINT, runs in a forked worker
+def run_worker(app, sock):
+  config = uvicorn.Config(
+    app,
+    lifespan="on",
+    log_level=WEB_LOG_LEVEL,
+    timeout_keep_alive=WEB_KEEP_ALIVE,
+    timeout_graceful_shutdown=WEB_GRACEFUL_TIMEOUT,
+    limit_max_requests=WEB_MAX_REQUESTS or None,
+    proxy_headers=True,
+  )
+  uvicorn.Server(config).run(sockets=[sock])
+
+class Supervisor:
+  def __init__(self, app, sock, workers: int):
+    self.app = app
+    self.sock = sock
+    self.workers = workers
+    # pid -> start time
+    self.children = {}
+    self.stopping = False
+    self.deadline = None
+
+  def spawn(self):
+    pid = os.fork()
+    if pid == 0:
+      # worker: uvicorn installs its own SIGTERM/SIGINT handlers
+      for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+        signal.signal(signum, signal.SIG_DFL)
+      code = 0
+      try:
+        run_worker(self.app, self.sock)
+      except BaseException:
+        traceback.print_exc()
+        code = 1
+      finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+    self.children[pid] = time.monotonic()
+
+  def stop(self, signum, frame):
+    if self.stopping:
+      return
+    print("Stopping {} workers (graceful timeout {}s)...".format(len(self.children), WEB_GRACEFUL_TIMEOUT))
+    self.stopping = True
+    # a few seconds on top of the graceful timeout for the lifespan shutdown
+    self.deadline = time.monotonic() + WEB_GRACEFUL_TIMEOUT + 10
+    for pid in self.children:
+      self.signal_child(pid, signal.SIGTERM)
+
+  def signal_child(self, pid: int, signum):
+    try:
+      os.kill(pid, signum)
+    except ProcessLookupError:
+      pass
+
+  def reap(self):
+    while self.children:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except ChildProcessError:
+        self.children.clear()
+        return
+      if pid == 0:
+        return
+      started = self.children.pop(pid, None)
+      if started is None or self.stopping:
+        continue
+      print("Worker {} exited with status {}, starting a new one".format(pid, os.waitstatus_to_exitcode(status)))
+      if time.monotonic() - started < MIN_WORKER_UPTIME:
+        time.sleep(MIN_WORKER_UPTIME)
+      self.spawn()
+
+  def run(self):
+    signal.signal(signal.SIGTERM, self.stop)
+    signal.signal(signal.SIGINT, self.stop)
+    for _ in range(self.workers):
+      self.spawn()
+    print("Serving on {}:{} with {} workers (preload: {})".format(WEB_HOST, WEB_PORT, self.workers, WEB_PRELOAD))
+
+    while self.children:
+      self.reap()
+      if self.stopping and time.monotonic() > self.deadline:
+        for pid in list(self.children):
+          print("Worker {} did not stop in time, killing it".format(pid))
+          self.signal_child(pid, signal.SIGKILL)
+        self.deadline = float("inf")
+      time.sleep(0.2)
+    self.sock.close()
+
+if __name__ == "__main__":
+  sock = bind_socket(WEB_HOST, WEB_PORT)
+  app = preload_app() if WEB_PRELOAD else APP
+  Supervisor(app, sock, WEB_WORKERS).run()
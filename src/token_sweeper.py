@@ -0,0 +1,52 @@
+import asyncio
+import os
+import random
+from src.metrics import TOKENS_SWEPT
+
+# Expired tokens are deleted in the background every TOKEN_SWEEP_INTERVAL seconds (0 disables it),
+# in batches of TOKEN_SWEEP_BATCH_SIZE rows so a run never holds long locks on the token table
+TOKEN_SWEEP_INTERVAL = float(os.getenv("TOKEN_SWEEP_INTERVAL", 300))
+TOKEN_SWEEP_BATCH_SIZE = int(os.getenv("TOKEN_SWEEP_BATCH_SIZE", 1000))
+# batches per run, what is left is deleted by the next runs
+TOKEN_SWEEP_MAX_BATCHES = int(os.getenv("TOKEN_SWEEP_MAX_BATCHES", 50))
+
+_sweep_batch = None
+_sweeper = None
+
+# Deletes expired tokens batch after batch until none is left or TOKEN_SWEEP_MAX_BATCHES ran, returns the count
+async def sweep_tokens() -> int:
+  total = 0
+  for _ in range(TOKEN_SWEEP_MAX_BATCHES):
+    deleted = await _sweep_batch(TOKEN_SWEEP_BATCH_SIZE)
+    total += deleted
+    TOKENS_SWEPT.inc(amount=deleted)
+    if deleted < TOKEN_SWEEP_BATCH_SIZE:
+      break
+  return total
+
+# Starts the periodic sweep, sweep_batch(batch_size) is awaited for every batch and returns the rows it deleted
+async def start_token_sweeper(sweep_batch):
+  global _sweep_batch, _sweeper
+  if TOKEN_SWEEP_INTERVAL <= 0 or _sweeper is not None:
+    return
+  _sweep_batch = sweep_batch
+  _sweeper = asyncio.create_task(_sweep_loop())
+
+async def stop_token_sweeper():
+  global _sweeper
+  if _sweeper is not None:
+    _sweeper.cancel()
+    await asyncio.gather(_sweeper, return_exceptions=True)
+    _sweeper = None
+
+async def _sweep_loop():
+  while True:
+    # jitter, so the workers of a server do not sweep at the same time
+    await asyncio.sleep(TOKEN_SWEEP_INTERVAL * random.uniform(0.9, 1.1))
+    try:
+      await sweep_tokens()
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      print("Error while sweeping expired tokens, will retry:")
+      print(e)
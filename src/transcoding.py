@@ -0,0 +1,135 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import ffmpeg
+from src.metrics import register_queue, TRANSCODE_JOBS, TRANSCODE_SECONDS, TRANSCODE_BYTES
+
+# renditions produced from every uploaded video (height in pixels), never upscaled
+RENDITIONS = ["1080", "720", "480", "360", "240", "144"]
+
+# transcoding is cpu bound: one ffmpeg process per core by default, shared by the web workers of src.server
+# (each one runs its own pool, so a pool gets cpu_count // WEB_WORKERS processes, at least one). WEB_WORKERS is
+# resolved by src.server, an unset or unresolved value (0, e.g. under plain uvicorn) means a single worker
+TRANSCODE_ENABLED = os.getenv("TRANSCODE_ENABLED", "true").lower() in ("1", "true", "yes")
+_web_workers = max(int(os.getenv("WEB_WORKERS") or 1), 1)
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", 0)) or max((os.cpu_count() or 1) // _web_workers, 1)
+TRANSCODE_QUEUE_SIZE = int(os.getenv("TRANSCODE_QUEUE_SIZE", 1000))
+# on shutdown, queued jobs get this many seconds to finish before being dropped (0: dropped right away)
+TRANSCODE_DRAIN_TIMEOUT = float(os.getenv("TRANSCODE_DRAIN_TIMEOUT", 0))
+
+_pool = None
+_queue = None
+_consumers = []
+_on_rendition = None
+
+register_queue("transcoding", lambda: _queue.qsize() if _queue is not None else 0)
+
+############################################################## WORKER PROCESS ##############################################################
+# these run in the process pool, keep them free of db/controller imports
+
+# Returns the height of the video stream of the file
+def probe_height(source: str) -> int:
+  probe = ffmpeg.probe(source)
+  video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
+  return 0 if video_stream is None else int(video_stream['height'])
+
+# Transcodes source to the given height, written to a temporary file renamed once complete
+def transcode_rendition(source: str, height: str, destination: str) -> str:
+  os.makedirs(os.path.dirname(destination), exist_ok=True)
+  tmp_destination = "{}.part.mp4".format(destination)
+  (
+    ffmpeg
+    .input(source)
+    .output(
+      tmp_destination,
+      vf="scale=-2:{}".format(height),
+      vcodec="libx264",
+      preset="veryfast",
+      crf=23,
+      acodec="aac",
+      movflags="+faststart",
+    )
+    .overwrite_output()
+    .run(quiet=True)
+  )
+  os.replace(tmp_destination, destination)
+  return destination
+
+############################################################## JOB QUEUE ##############################################################
+
+# Public uri of a rendition, relative to the public directory
+def rendition_uri(video_id: int, code: str) -> str:
+  return "videos/{}/{}.mp4".format(video_id, code)
+
+# Starts the process pool and the consumers of the job queue
+# on_rendition(video_id, code, uri) is awaited for every finished rendition
+async def start_transcoding(on_rendition):
+  global _pool, _queue, _consumers, _on_rendition
+  if not TRANSCODE_ENABLED or _pool is not None:
+    return
+  _on_rendition = on_rendition
+  # spawn: workers must not inherit the event loop, the db pools or the threads of the app
+  _pool = ProcessPoolExecutor(max_workers=TRANSCODE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+  _queue = asyncio.Queue(maxsize=TRANSCODE_QUEUE_SIZE)
+  _consumers = [asyncio.create_task(_consume()) for _ in range(TRANSCODE_WORKERS)]
+
+# Stops the consumers, running ffmpeg processes are waited for
+# queued jobs are given TRANSCODE_DRAIN_TIMEOUT seconds to complete first
+async def stop_transcoding():
+  global _pool, _queue, _consumers
+  if _pool is None:
+    return
+  if TRANSCODE_DRAIN_TIMEOUT > 0:
+    try:
+      await asyncio.wait_for(_queue.join(), TRANSCODE_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+      print("Transcoding queue not drained, dropping {} jobs".format(_queue.qsize()))
+  for consumer in _consumers:
+    consumer.cancel()
+  await asyncio.gather(*_consumers, return_exceptions=True)
+  _pool.shutdown(wait=True, cancel_futures=True)
+  _pool, _queue, _consumers = None, None, []
+
+# Queues the transcoding of an uploaded video, returns False when it could not be queued
+def enqueue_video(video_id: int, source: str) -> bool:
+  return _enqueue(("probe", video_id, source, None))
+
+def _enqueue(job) -> bool:
+  if _queue is None:
+    return False
+  try:
+    _queue.put_nowait(job)
+    return True
+  except asyncio.QueueFull:
+    print("Transcoding queue is full, dropping job for video {}".format(job[1]))
+    return False
+
+async def _consume():
+  loop = asyncio.get_running_loop()
+  while True:
+    kind, video_id, source, code = await _queue.get()
+    started = perf_counter()
+    try:
+      if kind == "probe":
+        # one job per rendition so the ladder of a video spreads over the cores
+        height = await loop.run_in_executor(_pool, probe_height, source)
+        for rendition in RENDITIONS:
+          if int(rendition) <= height:
+            _enqueue(("rendition", video_id, source, rendition))
+      else:
+        destination = "{}/public/{}".format(os.getcwd(), rendition_uri(video_id, code))
+        await loop.run_in_executor(_pool, transcode_rendition, source, code, destination)
+        TRANSCODE_SECONDS.observe(perf_counter() - started, code)
+        TRANSCODE_BYTES.inc(amount=os.path.getsize(destination))
+        await _on_rendition(video_id, code, rendition_uri(video_id, code))
+      TRANSCODE_JOBS.inc(kind, "ok")
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      TRANSCODE_JOBS.inc(kind, "error")
+      print("Error while transcoding video {}:".format(video_id))
+      print(e)
+    finally:
+      _queue.task_done()
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import tempfile
+import uuid
+from datetime import datetime
+from fastapi.concurrency import run_in_threadpool
+try:
+  from python_multipart.multipart import MultipartParser, parse_options_header
+  from python_multipart.exceptions import FormParserError
+except ModuleNotFoundError:
+  # python-multipart < 0.0.13
+  from multipart.multipart import MultipartParser, parse_options_header
+  from multipart.exceptions import FormParserError
+
+# Streaming receiver of multipart/form-data uploads: unlike the form parsing of Starlette (a spool file per
+# uploaded file, copied afterwards), the files are written once, straight to their destination directory
+UPLOAD_TOO_LARGE = "Upload is too large"
+INVALID_FORM = "Invalid multipart form"
+
+# text fields are kept in memory, up to this size each (bytes)
+MAX_FIELD_SIZE = 64 * 1024
+# multipart framing and text fields allowed on top of the files by the Content-Length check
+FORM_OVERHEAD = 1024 * 1024
+
+# A file of the form, written to a temporary file of the destination directory and hashed on the way
+class ReceivedFile:
+  def __init__(self, filename: str, content_type: str, directory: str):
+    self.filename = filename
+    self.content_type = content_type
+    handle, self.path = tempfile.mkstemp(dir=directory, prefix=".upload-", suffix=".part")
+    self.size = 0
+    self._digest = hashlib.sha256()
+    self._file = os.fdopen(handle, "wb")
+
+  def sha256(self) -> str:
+    return self._digest.hexdigest()
+
+  # counts and hashes data received from the client, written later by write
+  def received(self, data: bytes):
+    self.size += len(data)
+    self._digest.update(data)
+
+  def write(self, data: bytes):
+    self._file.write(data)
+
+  def close(self):
+    if not self._file.closed:
+      self._file.close()
+
+  # removes the temporary file (refused or failed upload)
+  def discard(self):
+    self.close()
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+# Reads the multipart body of request, returns the text fields {name: value} and the files {name: ReceivedFile}
+# - the body is refused with ValueError(UPLOAD_TOO_LARGE) before it is read when its Content-Length is bigger than
+#   max_size (+ FORM_OVERHEAD), and as soon as a file exceeds max_size otherwise (chunked bodies)
+# - accept_file(field, filename, content_type) is called once the headers of a file are read,
+#   it raises to refuse the file before any of its data is written
+# - file data is written in the threadpool, chunk_size bytes at a time
+# On any error the files received so far are removed
+async def receive_form(request, directory: str, max_size: int, accept_file, chunk_size: int = 1024 * 1024):
+  content_length = request.headers.get("content-length")
+  if content_length is not None and content_length.isdigit() and int(content_length) > max_size + FORM_OVERHEAD:
+    raise ValueError(UPLOAD_TOO_LARGE)
+  content_type, params = parse_options_header(request.headers.get("content-type", ""))
+  if content_type != b"multipart/form-data" or b"boundary" not in params:
+    raise ValueError(INVALID_FORM)
+
+  fields, files = {}, {}
+  state = {"headers": {}, "header_name": b"", "header_value": b"", "field": None, "file": None, "data": b""}
+  # (file, data) not written yet, written in one go once they hold chunk_size bytes
+  pending = []
+  pending_size = [0]
+
+  def on_part_begin():
+    state.update(headers={}, field=None, file=None, data=b"")
+
+  def on_header_field(data, start, end):
+    state["header_name"] += data[start:end]
+
+  def on_header_value(data, start, end):
+    state["header_value"] += data[start:end]
+
+  def on_header_end():
+    state["headers"][state["header_name"].lower()] = state["header_value"]
+    state["header_name"], state["header_value"] = b"", b""
+
+  def on_headers_finished():
+    _, options = parse_options_header(state["headers"].get(b"content-disposition", b""))
+    if b"name" not in options:
+      raise ValueError(INVALID_FORM)
+    state["field"] = options[b"name"].decode("utf-8", "replace")
+    if b"filename" in options:
+      filename = os.path.basename(options[b"filename"].decode("utf-8", "replace"))
+      content_type = state["headers"].get(b"content-type", b"application/octet-stream").decode("latin-1")
+      accept_file(state["field"], filename, content_type)
+      if state["field"] in files:
+        raise ValueError(INVALID_FORM)
+      state["file"] = files[state["field"]] = ReceivedFile(filename, content_type, directory)
+
+  def on_part_data(data, start, end):
+    chunk = data[start:end]
+    received = state["file"]
+    if received is None:
+      state["data"] += chunk
+      if len(state["data"]) > MAX_FIELD_SIZE:
+        raise ValueError(INVALID_FORM)
+      return
+    received.received(chunk)
+    if received.size > max_size:
+      raise ValueError(UPLOAD_TOO_LARGE)
+    pending.append((received, chunk))
+    pending_size[0] += len(chunk)
+
+  def on_part_end():
+    if state["file"] is None:
+      fields[state["field"]] = state["data"].decode("utf-8", "replace")
+
+  parser = MultipartParser(params[b"boundary"], {
+    "on_part_begin": on_part_begin,
+    "on_part_data": on_part_data,
+    "on_part_end": on_part_end,
+    "on_header_field": on_header_field,
+    "on_header_value": on_header_value,
+    "on_header_end": on_header_end,
+    "on_headers_finished": on_headers_finished,
+  })
+
+  async def write_pending():
+    items = pending[:]
+    pending.clear()
+    pending_size[0] = 0
+    await run_in_threadpool(_write_all, items)
+
+  try:
+    async for chunk in request.stream():
+      try:
+        parser.write(chunk)
+      except FormParserError:
+        raise ValueError(INVALID_FORM)
+      if pending_size[0] >= chunk_size:
+        await write_pending()
+    parser.finalize()
+    await write_pending()
+    for received in files.values():
+      await run_in_threadpool(received.close)
+    return fields, files
+  except Exception:
+    for received in files.values():
+      await run_in_threadpool(received.discard)
+    raise
+
+def _write_all(items):
+  for received, data in items:
+    received.write(data)
+
+# Moves a received file to directory/filename, prefixed with the date (and a random suffix if needed) when the
+# name is taken. The name is reserved with O_EXCL before the move, so concurrent uploads never overwrite each other
+def publish_file(path: str, directory: str, filename: str) -> str:
+  stamp = datetime.now().strftime("%Y%m%d%H%M%S")
+  candidates = [filename, "{}_{}".format(stamp, filename)]
+  while True:
+    for candidate in candidates:
+      target = os.path.join(directory, candidate)
+      try:
+        os.close(os.open(target, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+      except FileExistsError:
+        continue
+      os.replace(path, target)
+      return target
+    candidates = ["{}_{}_{}".format(stamp, uuid.uuid4().hex[:8], filename)]
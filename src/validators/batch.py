@@ -0,0 +1,20 @@
+from src.models import ApiException
+import os
+
+# most ids a batch route resolves in one request
+BATCH_MAX_IDS = int(os.getenv("BATCH_MAX_IDS", 100))
+
+# This function will validate a comma separated list of ids and return them as ints, without duplicates
+def validate_ids(ids: str):
+  if not ids:
+    raise ApiException(400, 1001, ["ids are required"])
+  try:
+    parsed = [int(id) for id in ids.split(",") if id.strip() != ""]
+  except ValueError:
+    raise ApiException(400, 1001, ["ids must be a comma separated list of integers"])
+  parsed = list(dict.fromkeys(parsed))
+  if len(parsed) == 0:
+    raise ApiException(400, 1001, ["ids are required"])
+  if len(parsed) > BATCH_MAX_IDS:
+    raise ApiException(400, 1001, ["At most {} ids can be requested at once".format(BATCH_MAX_IDS)])
+  return parsed
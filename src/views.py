@@ -0,0 +1,86 @@
+import asyncio
+import os
+from threading import Lock
+from src.metrics import register_queue
+
+# Views are buffered per worker and written in batched UPDATEs (views = views + n)
+# every VIEWS_FLUSH_INTERVAL seconds, or sooner once VIEWS_FLUSH_THRESHOLD views are pending
+VIEWS_FLUSH_INTERVAL = float(os.getenv("VIEWS_FLUSH_INTERVAL", 5))
+VIEWS_FLUSH_THRESHOLD = int(os.getenv("VIEWS_FLUSH_THRESHOLD", 1000))
+
+_pending = {}
+_pending_total = 0
+# batch being written, still counted by pending_views until the write is done
+_flushing = {}
+_lock = Lock()
+_writer = None
+_flusher = None
+_flush_requested = None
+
+register_queue("views", lambda: _pending_total)
+
+# Counts one view of a video
+def record_view(video_id: int):
+  global _pending_total
+  with _lock:
+    _pending[video_id] = _pending.get(video_id, 0) + 1
+    _pending_total += 1
+    full = _pending_total >= VIEWS_FLUSH_THRESHOLD
+  if full and _flush_requested is not None:
+    _flush_requested.set()
+
+# Views of a video not written to the db yet, added to the stored count by the read path
+def pending_views(video_id: int) -> int:
+  return _pending.get(video_id, 0) + _flushing.get(video_id, 0)
+
+# Writes the pending views, put back in the buffer if the write fails
+# without a writer (counter not started) the views stay buffered, one batch is written at a time
+async def flush_views():
+  global _pending, _pending_total, _flushing
+  with _lock:
+    if not _pending or _writer is None or _flushing:
+      return
+    batch = _flushing = _pending
+    _pending, _pending_total = {}, 0
+  written = False
+  try:
+    await _writer(batch)
+    written = True
+  except Exception as e:
+    print("Error while flushing video views, will retry:")
+    print(e)
+  finally:
+    # also reached when the flush is cancelled, the views are then written by the next one
+    with _lock:
+      _flushing = {}
+      if not written:
+        for video_id, count in batch.items():
+          _pending[video_id] = _pending.get(video_id, 0) + count
+          _pending_total += count
+
+# Starts the periodic flush, writer(batch) is awaited with {video_id: views} for every batch
+async def start_view_counter(writer):
+  global _writer, _flusher, _flush_requested
+  if _flusher is not None:
+    return
+  _writer = writer
+  _flush_requested = asyncio.Event()
+  _flusher = asyncio.create_task(_flush_loop())
+
+# Stops the periodic flush and writes what is still pending (graceful shutdown)
+async def stop_view_counter():
+  global _flusher
+  if _flusher is not None:
+    _flusher.cancel()
+    await asyncio.gather(_flusher, return_exceptions=True)
+    _flusher = None
+  await flush_views()
+
+async def _flush_loop():
+  while True:
+    try:
+      await asyncio.wait_for(_flush_requested.wait(), VIEWS_FLUSH_INTERVAL)
+    except asyncio.TimeoutError:
+      pass
+    _flush_requested.clear()
+    await flush_views()
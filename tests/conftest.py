@@ -0,0 +1,15 @@
+# The app reads its settings at import time: every test runs on a sqlite file of a temporary directory
+import os
+import shutil
+import tempfile
+
+_directory = tempfile.mkdtemp(prefix="api-tests-")
+os.environ["DB_URL"] = "sqlite:///{}".format(os.path.join(_directory, "test.db"))
+os.environ["DB_REPLICA_URLS"] = ""
+os.environ["TRANSCODE_ENABLED"] = "false"
+os.environ.setdefault("SECRET_KEY", "test-secret")
+
+def pytest_sessionfinish(session, exitstatus):
+  from src.db.connection import get_engine
+  get_engine().dispose()
+  shutil.rmtree(_directory, ignore_errors=True)
@@ -0,0 +1,35 @@
+# get_videos loads a page with a constant number of statements, whatever its size (no N+1 on owners and formats)
+# runs on a sqlite file seeded with the benchmark schema: python -m pytest tests
+import pytest
+from sqlalchemy import event
+
+@pytest.fixture(scope="module")
+def engine():
+  from benchmarks import seed
+  from src.db.connection import get_engine
+  seed.run(users=10, videos_per_user=20, formats_per_video=3, comments_per_video=0, reset=True)
+  yield get_engine()
+
+# Statements executed by get_videos for body, with a cold pager count cache
+def count_statements(engine, body) -> int:
+  from src.controllers.video import get_videos
+  from src.pagination import count_cache
+  count_cache.clear()
+  statements = []
+  def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+  event.listen(engine, "after_cursor_execute", after_cursor_execute)
+  try:
+    result = get_videos(body)
+  finally:
+    event.remove(engine, "after_cursor_execute", after_cursor_execute)
+  assert len(result["data"]) == body.perPage
+  return len(statements)
+
+def test_get_videos_statements_do_not_grow_with_the_page(engine):
+  from src.models import VideoList
+  assert count_statements(engine, VideoList(perPage=1)) == count_statements(engine, VideoList(perPage=100))
+
+def test_get_videos_of_a_user_statements_do_not_grow_with_the_page(engine):
+  from src.models import VideoList
+  assert count_statements(engine, VideoList(user=1, perPage=1)) == count_statements(engine, VideoList(user=1, perPage=20))
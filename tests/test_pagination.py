@@ -0,0 +1,14 @@
+# the totals of full-text searches are cached with keys compiled for the dialect of the db
+from sqlalchemy import select, func
+from sqlalchemy.dialects import mysql
+from benchmarks.seed import user_table
+import src.search
+from src.pagination import count_key
+
+def test_fulltext_count_statement_compiles_for_mysql(monkeypatch):
+  monkeypatch.setattr(src.search, "fulltext_enabled", lambda: True)
+  pseudo_filter, relevance = src.search.search_filter(user_table.c.pseudo, "alice bob")
+  assert relevance is not None
+  statement, params = count_key(select(func.count(user_table.c.id)).where(pseudo_filter), mysql.dialect())
+  assert "MATCH (user.pseudo) AGAINST" in statement
+  assert params == (("param_1", repr("+alice* +bob*")),)
@@ -0,0 +1,41 @@
+# video files are served whole, as a single range (206) or refused when the range can not be satisfied (416)
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+from src.responses import RangeFileResponse, parse_range
+
+CONTENT = bytes(range(256)) * 4
+
+@pytest.fixture
+def client(tmp_path):
+  path = tmp_path / "video.mp4"
+  path.write_bytes(CONTENT)
+  async def video(request):
+    return RangeFileResponse(str(path), request)
+  return TestClient(Starlette(routes=[Route("/video", video)]))
+
+def test_parse_range():
+  assert parse_range("bytes=0-99", 1024) == (0, 99)
+  assert parse_range("bytes=1000-", 1024) == (1000, 1023)
+  assert parse_range("bytes=-24", 1024) == (1000, 1023)
+  assert parse_range("bytes=-0", 1024) is None
+  assert parse_range("bytes=2000-", 1024) is None
+
+def test_single_range_is_served_partially(client):
+  response = client.get("/video", headers={"range": "bytes=10-19"})
+  assert response.status_code == 206
+  assert response.headers["content-range"] == "bytes 10-19/1024"
+  assert response.content == CONTENT[10:20]
+
+@pytest.mark.parametrize("byte_range", ["bytes=0-99,200-299", "items=0-5", "bytes=-", "bytes=abc"])
+def test_unsupported_range_is_ignored(client, byte_range):
+  response = client.get("/video", headers={"range": byte_range})
+  assert response.status_code == 200
+  assert response.content == CONTENT
+
+@pytest.mark.parametrize("byte_range", ["bytes=-0", "bytes=5000-"])
+def test_unsatisfiable_range_is_refused(client, byte_range):
+  response = client.get("/video", headers={"range": byte_range})
+  assert response.status_code == 416
+  assert response.headers["content-range"] == "bytes */1024"
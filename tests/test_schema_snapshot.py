@@ -0,0 +1,44 @@
+# workers load a schema snapshot without querying the db, and reflect again once the migrations changed
+import pytest
+from sqlalchemy import event
+
+@pytest.fixture
+def snapshot(tmp_path):
+  from benchmarks import seed
+  from src.db import connection
+  seed.metadata.create_all(connection.get_engine(), checkfirst=True)
+  path = str(tmp_path / "schema.pickle")
+  connection.dump_schema_snapshot(path)
+  return path
+
+def test_snapshot_is_loaded_without_querying_the_db(snapshot):
+  from src.db import connection
+  statements = []
+  def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+  event.listen(connection.get_engine(), "after_cursor_execute", after_cursor_execute)
+  try:
+    metadata = connection.load_schema_snapshot(snapshot)
+  finally:
+    event.remove(connection.get_engine(), "after_cursor_execute", after_cursor_execute)
+  assert "video" in metadata.tables
+  assert statements == []
+
+def test_snapshot_taken_before_a_new_migration_is_ignored(snapshot, tmp_path, monkeypatch):
+  from src.db import connection
+  migrations = tmp_path / "initdb"
+  migrations.mkdir()
+  (migrations / "migration-999-new.sql").write_text("ALTER TABLE video ADD COLUMN rating INT;")
+  monkeypatch.setattr(connection, "MIGRATIONS_PATH", str(migrations))
+  assert connection.load_schema_snapshot(snapshot) is None
+
+def test_snapshot_check_sees_a_schema_change(snapshot):
+  from src.db import connection
+  assert connection.schema_snapshot_matches(snapshot)
+  with connection.get_engine().begin() as conn:
+    conn.exec_driver_sql("CREATE INDEX idx_snapshot_check ON video (name)")
+  try:
+    assert not connection.schema_snapshot_matches(snapshot)
+  finally:
+    with connection.get_engine().begin() as conn:
+      conn.exec_driver_sql("DROP INDEX idx_snapshot_check")
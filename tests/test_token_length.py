@@ -0,0 +1,15 @@
+# the codes of the api tokens fit token.code (VARCHAR(512) since initdb/migration-004)
+from datetime import datetime, timedelta
+from src.security import encode_token
+
+TOKEN_CODE_LENGTH = 512
+# username, pseudo and email are VARCHAR(45) in initdb/create-db.sql
+FIELD_LENGTH = 45
+
+def test_token_of_the_longest_user_fits_the_code_column():
+  code = encode_token(2 ** 31 - 1, "u" * FIELD_LENGTH, "p" * FIELD_LENGTH, "e" * (FIELD_LENGTH - 6) + "@x.com", datetime.now() + timedelta(hours=3))
+  assert len(code) <= TOKEN_CODE_LENGTH
+
+def test_tokens_issued_within_the_same_second_differ():
+  expires = datetime.now() + timedelta(hours=3)
+  assert encode_token(1, "alice", None, "alice@x.com", expires) != encode_token(1, "alice", None, "alice@x.com", expires)
@@ -0,0 +1,65 @@
+# uploads are streamed once to public/videos, refused before being written when too big, and never overwrite each other
+import asyncio
+import os
+import pytest
+from httpx import AsyncClient, ASGITransport
+
+@pytest.fixture(scope="module")
+def token():
+  from sqlalchemy import select
+  from benchmarks import seed
+  from src.db.connection import get_engine
+  seed.run(users=2, videos_per_user=1, formats_per_video=0, comments_per_video=0, reset=True)
+  with get_engine().connect() as connection:
+    return connection.execute(select(seed.token_table.c.code).where(seed.token_table.c.user_id == 1)).scalar()
+
+@pytest.fixture
+def public(tmp_path, monkeypatch):
+  # public/videos is resolved from the working directory
+  monkeypatch.chdir(tmp_path)
+  return tmp_path / "public" / "videos"
+
+def upload(token, files, data=None):
+  from src.main import app
+  async def send():
+    async with AsyncClient(transport=ASGITransport(app=app, raise_app_exceptions=False), base_url="http://test") as client:
+      return await client.post("/user/1/video", headers={"Authorization": token}, data=data, files=files)
+  return asyncio.run(send())
+
+def test_upload_is_saved_under_its_name_without_overwriting(token, public):
+  first = upload(token, {"source": ("clip.mp4", b"first", "video/mp4")}, {"name": "first"})
+  second = upload(token, {"source": ("clip.mp4", b"second", "video/mp4")}, {"name": "second"})
+  assert first.status_code == 201 and second.status_code == 201
+  assert first.json()["data"]["source"] != second.json()["data"]["source"]
+  assert sorted(path.read_bytes() for path in public.iterdir()) == [b"first", b"second"]
+
+def test_upload_over_the_limit_is_refused_before_being_written(token, public, monkeypatch):
+  import src.controllers.video
+  monkeypatch.setattr(src.controllers.video, "VIDEO_MAX_UPLOAD_SIZE", 10)
+  response = upload(token, {"source": ("big.mp4", b"x" * 100, "video/mp4")}, {"name": "big"})
+  assert response.status_code == 413
+  assert list(public.iterdir()) == []
+
+def test_upload_announcing_a_body_over_the_limit_is_refused_unread(token, public, monkeypatch):
+  import src.uploads
+  monkeypatch.setattr(src.uploads, "FORM_OVERHEAD", 0)
+  import src.controllers.video
+  monkeypatch.setattr(src.controllers.video, "VIDEO_MAX_UPLOAD_SIZE", 10)
+  response = upload(token, {"source": ("big.mp4", b"x" * 5, "video/mp4")}, {"name": "big"})
+  assert response.status_code == 413
+
+def test_upload_that_is_not_an_mp4_is_refused(token, public):
+  response = upload(token, {"source": ("clip.avi", b"avi", "video/x-msvideo")}, {"name": "avi"})
+  assert response.status_code == 400
+  assert list(public.iterdir()) == []
+
+def test_upload_without_name_is_refused(token, public):
+  response = upload(token, {"source": ("clip.mp4", b"data", "video/mp4")})
+  assert response.status_code == 400
+  assert [path for path in public.iterdir()] == []
+
+def test_upload_of_many_chunks_is_saved_whole(token, public):
+  content = os.urandom(3 * 1024 * 1024 + 123)
+  response = upload(token, {"source": ("long.mp4", content, "video/mp4")}, {"name": "long"})
+  assert response.status_code == 201
+  assert (public / "long.mp4").read_bytes() == content